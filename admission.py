@@ -0,0 +1,73 @@
+import threading
+
+# How many of its own transfers a peer keeps admitted before moneyTransfer waits for one to settle
+MAX_PENDING = 10000
+
+class TransferHandle:
+    # Returned by Peer.transfer for one admitted transfer
+    def __init__(self, admission, tx):
+        self.admission = admission
+        self.tx = tx
+        self.seq = None
+        self.outcome = None
+
+    def done(self):
+        return self.outcome is not None
+
+    def wait(self, timeout=None):
+        # "committed", "rejected" or "unknown", or None if the transfer is still in flight after timeout
+        with self.admission.cv:
+            self.admission.cv.wait_for(self.done, timeout)
+            return self.outcome
+
+class Admission:
+    # The peer's own transfers from submission until they settle. Each one reserves its amount on the
+    # paying account, so a transfer is admitted only if the committed balance minus what is already
+    # reserved covers it. That is one lookup however many transfers are in flight, and two transfers
+    # in flight can never both count on the same money. At most `capacity` are admitted at once.
+    def __init__(self, capacity=MAX_PENDING):
+        self.capacity = capacity
+        self.cv = threading.Condition()
+        self.admitted = 0
+        self.reserved = {}
+        self.handles = {}
+
+    def admit(self, tx, balance, timeout=None):
+        # Waits up to `timeout` seconds for room and returns a handle, or None if there is none. Raises
+        # ValueError when balance(), less the reservations on the paying account, does not cover the amount.
+        account, amount = tx[0], tx[2]
+        with self.cv:
+            if not self.cv.wait_for(lambda: self.admitted < self.capacity, timeout):
+                return None
+            available = balance() - self.reserved.get(account, 0)
+            if available < amount:
+                raise ValueError(f"Insufficient balance in account {account}. Available: {available}, amount needed: {amount}")
+            self.admitted += 1
+            self.reserved[account] = self.reserved.get(account, 0) + amount
+        return TransferHandle(self, tx)
+
+    def register(self, seq, handle):
+        # Called once the admitted transfer has its sequence number
+        with self.cv:
+            handle.seq = seq
+            self.handles[seq] = handle
+
+    def settle(self, seq, outcome):
+        # Releases the reservation and returns True; a transfer settles once, later reports of it
+        # are ignored and return False
+        with self.cv:
+            handle = self.handles.pop(seq, None)
+            if handle is None:
+                return False
+            account, amount = handle.tx[0], handle.tx[2]
+            self.reserved[account] -= amount
+            if not self.reserved[account]:
+                del self.reserved[account]
+            self.admitted -= 1
+            handle.outcome = outcome
+            self.cv.notify_all()
+            return True
+
+    def pending(self):
+        with self.cv:
+            return sorted(self.handles.values(), key=lambda handle: handle.seq), dict(self.reserved)
@@ -0,0 +1,157 @@
+from utils import parse_frame_header, decode_frame
+from transport import NETWORK_DELAY, RECOVERY_STREAM, CONNECT_TIMEOUT, SEND_TIMEOUT
+from concurrent.futures import wait
+import asyncio
+import threading
+import time
+
+class AsyncTransport:
+    # Runs a peer's networking on one asyncio event loop instead of a listener thread, a reader
+    # thread per connection and four workers. Handlers run on the loop one at a time, so they never
+    # contend with each other for the peer's locks; only the proposer thread and the client input
+    # still take them from outside. Handlers that stream a recovery wait for the other side to keep
+    # up, so those run on the loop's executor and hand their frames back to the loop. So does applying
+    # decided blocks, which waits for apply_lock and for the state log to make the blocks durable.
+    def __init__(self, delay=NETWORK_DELAY):
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+        self.connections = {}
+        self.send_locks = {}
+        self.tasks = set()
+
+    def clock(self):
+        return time.monotonic()
+
+    def start(self, peer):
+        self.peer = peer
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._listen())
+        started.set()
+        self.loop.run_forever()
+
+    async def _listen(self):
+        host, port = self.peer.config.address(self.peer.id)
+        self.server = await asyncio.start_server(self._connection, host, port, reuse_address=True)
+        if self.peer.debug:
+            print(f"[DEBUG C-{self.peer.id}] Listening on {host}:{port} (asyncio)")
+
+    def run_blocking(self, fn, *args):
+        if threading.current_thread() is self.thread:
+            self.loop.run_in_executor(None, fn, *args)
+        else:
+            fn(*args)
+
+    def send(self, target_id, frame):
+        if threading.current_thread() is self.thread:
+            self._spawn(target_id, frame, time.perf_counter())
+        else:
+            asyncio.run_coroutine_threadsafe(self._send(target_id, frame, time.perf_counter()), self.loop).result()
+
+    def broadcast(self, frames, timeout=None):
+        # Every target gets its own send, so a slow one holds up no other. Without a timeout this
+        # returns at once; with one it waits up to `timeout` seconds for the sends and returns the
+        # targets the frame was written to. Handlers on the loop cannot wait, so they get None.
+        queued = time.perf_counter()
+        if threading.current_thread() is self.thread:
+            for target_id, frame in frames.items():
+                self._spawn(target_id, frame, queued)
+            return None
+        futures = {asyncio.run_coroutine_threadsafe(self._send(target_id, frame, queued), self.loop): target_id
+                   for target_id, frame in frames.items()}
+        if timeout is None:
+            return None
+        finished, _ = wait(futures, timeout)
+        return {futures[f] for f in finished if f.result()}
+
+    def _spawn(self, target_id, frame, queued):
+        # Frames to one target keep their order through its lock, so the handler need not wait
+        task = self.loop.create_task(self._send(target_id, frame, queued))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, target_id, frame, queued):
+        lock = self.send_locks.setdefault(target_id, asyncio.Lock())
+        async with lock:
+            try:
+                for attempt in range(2):
+                    try:
+                        writer = await asyncio.wait_for(self._get_connection(target_id), CONNECT_TIMEOUT)
+                        writer.write(frame)
+                        await asyncio.wait_for(writer.drain(), SEND_TIMEOUT)
+                        self.peer.count("frames_sent")
+                        return True
+                    except Exception as e:
+                        self._close_connection(target_id)
+                        if attempt == 1 and self.peer.debug:
+                            print(f"[DEBUG C-{self.peer.id}] Could not send message to C-{target_id}, Error: {e}")
+                return False
+            finally:
+                self.peer.metrics.observe(f"send_to_{target_id}", time.perf_counter() - queued)
+
+    async def _get_connection(self, target_id):
+        # Caller holds the send lock for target_id
+        conn = self.connections.get(target_id)
+        if conn is not None and (conn[0].at_eof() or conn[1].is_closing()):
+            # Outgoing connections are write-only, so end of input means the peer closed it
+            self._close_connection(target_id)
+            conn = None
+        if conn is None:
+            if target_id in self.connections:
+                self.peer.count("reconnects")
+            reader, writer = await asyncio.open_connection(*self.peer.config.address(target_id))
+            writer.write(self.peer.hello_frame())
+            conn = self.connections[target_id] = (reader, writer)
+            if self.peer.debug:
+                print(f"[DEBUG C-{self.peer.id}] Opened connection to C-{target_id}")
+        return conn[1]
+
+    def _close_connection(self, target_id):
+        conn = self.connections.get(target_id)
+        if conn is not None:
+            conn[1].close()
+            self.connections[target_id] = None
+
+    async def _connection(self, reader, writer):
+        streams = {}
+        try:
+            while True:
+                try:
+                    length, compressed = parse_frame_header(await reader.readexactly(4))
+                    req = decode_frame(await reader.readexactly(length), compressed)
+                except asyncio.IncompleteReadError:
+                    break
+                except (OSError, ValueError) as e:
+                    if self.peer.debug:
+                        print(f"[DEBUG C-{self.peer.id}] Closing connection, Error: {e}")
+                    break
+                if not self.peer.receive(req):
+                    continue
+                if req["type"] in RECOVERY_STREAM:
+                    # The next frame is read only once this chunk is applied, which holds back the sender
+                    await self.loop.run_in_executor(None, self.peer.handle_recovery_stream, req, streams)
+                elif req["type"] == "Recovery":
+                    self.loop.call_later(self.delay, self._handle, self.loop.time() + self.delay, True, req)
+                else:
+                    # Simulated network delay, without holding up the messages behind this one
+                    self.loop.call_later(self.delay, self._handle, self.loop.time() + self.delay, False, req)
+        finally:
+            # A stream cut off by a dropped connection is abandoned; the gap timer asks again
+            for stream in streams.values():
+                self.peer.drop_recovery_stream(stream)
+            writer.close()
+
+    def _handle(self, due, in_executor, req):
+        # How late the loop gets to a message is its queue wait
+        self.peer.metrics.observe("queue_wait", max(self.loop.time() - due, 0))
+        if self.peer.superseded(req):
+            return
+        if in_executor:
+            self.loop.run_in_executor(None, self.peer.handle_request, req)
+        else:
+            self.peer.handle_request(req)
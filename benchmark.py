@@ -0,0 +1,467 @@
+from blockchain import Block, BlockChain, generate_hash, set_difficulty, difficulty, canonical_encoding, sha256_transaction, block_digest, transactions_of
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from utils import encode_payload, decode_payload, dict_from_block, load_file, overwrite_file
+from transport import SimNetwork, TcpTransport
+from aio import AsyncTransport
+from peer import Peer
+from config import ClusterConfig
+from collections import Counter
+import contextlib
+import io
+
+# Every benchmark prints a summary and returns its numbers, which --out writes to a JSON file
+# that `compare` can check against the file of another version.
+
+def percentile(values, p):
+    # Nearest rank on a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def make_records(blocks, batch):
+    # Chained blocks with valid hashes, without the cost of a proof of work
+    records = []
+    prev_digest = None
+    for i in range(blocks):
+        tx = [(1, 2, i)] * batch
+        encoding = canonical_encoding(tx)
+        nonce = format(i, "08x")
+        hash_value = sha256_transaction(tx, nonce, encoding)
+        records.append((tx, nonce, hash_value, prev_digest))
+        prev_digest = block_digest(encoding, nonce, hash_value)
+    return records
+
+def chain_from_records(records):
+    bc = BlockChain()
+    for tx, nonce, hash_value, hash_pointer in records:
+        bc.append(Block.reconstruct(tx, nonce, hash_value, bc.get_tail(), hash_pointer))
+    return bc
+
+def bench_pow(max_workers, zeros, blocks):
+    set_difficulty(difficulty["suffix"], zeros)
+    transactions = [[(1, 2, i), (3, 4, i + 1)] for i in range(blocks)]
+
+    print(f"Proof of work: {blocks} blocks, suffix={difficulty['suffix']!r}, zeros={zeros}")
+    results = {}
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        generate_hash(transactions[0], workers)  # start the process pool outside the timing
+
+        hashes = 0
+        start = time.perf_counter()
+        for tx in transactions:
+            nonce, _ = generate_hash(tx, workers)
+            hashes += int(nonce, 16) + 1
+        elapsed = time.perf_counter() - start
+
+        rate = hashes / elapsed
+        baseline = baseline or rate
+        results[f"workers_{workers}"] = {"hashes_per_s": rate}
+        print(f"workers={workers}: {rate:,.0f} hashes/s ({rate / baseline:.2f}x), {elapsed:.2f}s")
+    return results
+
+def bench_chain(blocks):
+    # Hashes are made up; only the shape of the stored records matters here
+    print(f"Chain store: {blocks:,} blocks")
+    tracemalloc.start()
+    start = time.perf_counter()
+    bc = BlockChain()
+    for i in range(blocks):
+        bc.append(Block.reconstruct([(1, 2, i)], format(i, "08x"), format(i, "064x"), bc.get_tail(), format(i - 1, "064x") if i else None))
+    build = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"build: {build:.2f}s, {size / 2**20:.1f} MiB ({size / blocks:.0f} bytes/block), peak {peak / 2**20:.1f} MiB")
+
+    lookups = [random.randrange(blocks) for _ in range(100_000)]
+    start = time.perf_counter()
+    for n in lookups:
+        bc[n]
+    index_ns = (time.perf_counter() - start) / len(lookups) * 1e9
+    print(f"random index: {index_ns:.0f} ns/lookup")
+
+    start = time.perf_counter()
+    count = sum(1 for _ in bc)
+    iterate_ns = (time.perf_counter() - start) / count * 1e9
+    print(f"iterate: {iterate_ns:.0f} ns/block")
+
+    start = time.perf_counter()
+    block = bc.tail
+    while block is not None:
+        block = block.prev
+    walk_ns = (time.perf_counter() - start) / blocks * 1e9
+    print(f"walk prev links: {walk_ns:.0f} ns/block")
+    return {"build_s": build, "bytes_per_block": size / blocks, "peak_bytes": peak,
+            "index_ns": index_ns, "iterate_ns": iterate_ns, "walk_ns": walk_ns}
+
+def bench_block(blocks, batch):
+    # Block.verify on blocks that have not cached their encoding yet, as when they arrive
+    records = make_records(blocks, batch)
+    print(f"Block verification: {blocks:,} blocks of {batch} transfers")
+    chain = chain_from_records(records)
+    start = time.perf_counter()
+    prev = None
+    for block in chain:
+        assert block.verify(prev)
+        prev = block
+    elapsed = time.perf_counter() - start
+    print(f"Block.verify: {elapsed / blocks * 1e6:.1f} us/block, {blocks / elapsed:,.0f} blocks/s")
+    return {"us_per_block": elapsed / blocks * 1e6, "blocks_per_s": blocks / elapsed}
+
+def bench_verify(max_workers, blocks, batch):
+    records = make_records(blocks, batch)
+
+    print(f"Chain verification: {blocks:,} blocks of {batch} transfers")
+    results = {}
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        # A fresh chain each time, so no run profits from encodings cached by the one before
+        bc = chain_from_records(records)
+        if workers > 1:
+            bc.verify(workers)  # start the process pool outside the timing; workers keep no state between runs
+
+        start = time.perf_counter()
+        assert bc.verify(workers)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        results[f"workers_{workers}"] = {"blocks_per_s": blocks / elapsed}
+        print(f"workers={workers}: {blocks / elapsed:,.0f} blocks/s ({baseline / elapsed:.2f}x), {elapsed:.2f}s")
+    return results
+
+def bench_storage(blocks, batch):
+    # Rewriting a whole state file, then loading it with and without the verified checkpoint. Loading
+    # from the checkpoint only maps the chain file, so it should not grow with the chain.
+    bc = chain_from_records(make_records(blocks, batch))
+    account_table = {i: 100 for i in range(1, 6)}
+    print(f"State file: {blocks:,} blocks of {batch} transfers")
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        path = os.path.join(tmp, "c_1.json")
+        start = time.perf_counter()
+        overwrite_file(path, account_table, (1, 1), bc)
+        write = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+
+        start = time.perf_counter()
+        _, _, loaded = load_file(path)
+        load = time.perf_counter() - start
+        assert loaded.len == blocks
+
+        # Without the checkpoint's verified depth every block is checked again
+        with open(path) as f:
+            data = json.load(f)
+        data.pop("verified", None)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        start = time.perf_counter()
+        load_file(path)
+        load_full = time.perf_counter() - start
+    print(f"overwrite_file: {write:.2f}s, {size / blocks:.0f} bytes/block on disk")
+    print(f"load_file: {load * 1000:.1f} ms from checkpoint, {load_full:.2f}s with full verification")
+    return {"overwrite_s": write, "load_s": load, "load_full_verify_s": load_full, "bytes_per_block": size / blocks}
+
+def sample_messages(batch):
+    bc = BlockChain()
+    for i in range(2):
+        bc.append(bc.new_block([(1, 2, i)] * batch))
+    block = bc.get_tail()
+    ballot = (12, 3)
+    block_fields = {"tx": block.transaction, "nonce": block.nonce, "hash_value": block.hash_value, "hash_pointer": block.hash_pointer}
+    return {
+        "Prepare": {"type": "Prepare", "ballot": ballot, "from": 3, "depth": 1000},
+        "Promise": {"type": "Promise", "ballot": ballot, "from": 2, "depth": 1000, "accepted": [[1000, [11, 5], dict_from_block(block)]]},
+        "Accept": {"type": "Accept", "ballot": ballot, "from": 3, "depth": 1000, **block_fields},
+        "Accepted": {"type": "Accepted", "ballot": ballot, "from": 2, "depth": 1000},
+        "Nack": {"type": "Nack", "ballot": ballot, "from": 2, "promised": (13, 4), "depth": 999},
+        "Decision": {"type": "Decision", "from": 3, "depth": 1000, **block_fields},
+        "Recovery": {"type": "Recovery", "from": 4, "depth": 990, "tail_hash": block.hash_value},
+    }
+
+def bench_wire(batch, rounds):
+    print(f"Wire formats: blocks of {batch} transfers, {rounds:,} rounds per message")
+    results = {}
+    for name, msg in sample_messages(batch).items():
+        lines = []
+        for fmt, binary in (("json", False), ("binary", True)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                data = encode_payload(msg, binary)
+            encode_us = (time.perf_counter() - start) / rounds * 1e6
+            start = time.perf_counter()
+            for _ in range(rounds):
+                decode_payload(data)
+            decode_us = (time.perf_counter() - start) / rounds * 1e6
+            results[f"{name}_{fmt}"] = {"bytes": len(data), "encode_us": encode_us, "decode_us": decode_us}
+            lines.append(f"{len(data):5d} B, enc {encode_us:5.1f} us, dec {decode_us:5.1f} us")
+        print(f"{name:9s} json: {lines[0]} | binary: {lines[1]}")
+    return results
+
+def workload(mode, transfers, peers=5, seed=0):
+    # Yields (origin peer, from, to) for each transfer, with one account per peer:
+    #   single - every transfer is submitted at peer 1
+    #   all    - each transfer is submitted at the peer that owns the paying account
+    #   hot    - every transfer pays into or out of account 1, submitted at any peer
+    rng = random.Random(seed)
+    for _ in range(transfers):
+        if mode == "hot":
+            other = rng.randint(2, peers)
+            from_id, to_id = (1, other) if rng.random() < 0.5 else (other, 1)
+            origin = rng.randint(1, peers)
+        else:
+            from_id, to_id = rng.sample(range(1, peers + 1), 2)
+            origin = 1 if mode == "single" else from_id
+        yield origin, from_id, to_id
+
+def check_replicas(peers, committed):
+    # Every replica must hold the same blocks and the same table, and the transfers on the chain
+    # must be exactly those reported committed; the workload is funded so that none is rejected
+    chains = {tuple(block.hash_value for block in p.blockchain) for p in peers.values()}
+    tables = {tuple(sorted(p.account_table.items())) for p in peers.values()}
+    chain_transfers = sum(len(transactions_of(block.transaction)) for block in next(iter(peers.values())).blockchain)
+    return {
+        "same_chain": len(chains) == 1,
+        "same_table": len(tables) == 1,
+        "chain_transfers": chain_transfers,
+        "committed_outcomes": committed,
+        "consistent": len(chains) == 1 and len(tables) == 1 and chain_transfers == committed,
+    }
+
+def bench_cluster(mode, transfers, rate, transport, batch_size, window, latency, drop, balance, timeout, delay=0, n_peers=5, thrifty=False, stable_leader=True, accounts=None):
+    # A cluster of `n_peers` peers in this process, without disk writes. The TCP and asyncio
+    # transports listen on the usual ports and hold each message for `delay` seconds. Without a
+    # stable leader every peer prepares its own blocks, so proposers contend for each depth.
+    # `accounts` sizes the account table; the workload only moves money between the first `n_peers`.
+    # Afterwards the replicas are checked against each other and against the reported outcomes.
+    config = ClusterConfig.local(n_peers, accounts)
+    net = None
+    if transport == "sim":
+        net = SimNetwork(latency=lambda rng: rng.uniform(latency / 2, latency * 1.5), drop=drop)
+        make_transport = net.transport
+    elif transport == "asyncio":
+        make_transport = lambda: AsyncTransport(delay)
+    else:
+        make_transport = lambda: TcpTransport(delay)
+
+    submitted = {}
+    committed = {}
+    outcomes = Counter()
+    commit_lock = threading.Lock()
+
+    def on_commit(origin, seq):
+        now = time.perf_counter()
+        with commit_lock:
+            committed.setdefault((origin, seq), now)
+
+    def on_outcome(seq, outcome):
+        with commit_lock:
+            outcomes[outcome] += 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        peers = {i: Peer(i, batch_size=batch_size, window=window, transport=make_transport(), persist=False, round_timeout=5, config=config, thrifty=thrifty, stable_leader=stable_leader) for i in config.members}
+        for peer in peers.values():
+            # Every peer starts from the same table, funded so that no ordering of the workload overdraws
+            peer.account_table = {i: balance for i in config.accounts}
+            peer.on_commit = lambda seq, origin=peer.id: on_commit(origin, seq)
+            peer.on_outcome = on_outcome
+
+        start = time.perf_counter()
+        for k, (origin, from_id, to_id) in enumerate(workload(mode, transfers, config.size)):
+            if rate:
+                # Open loop: transfers go out on schedule however far behind the commits are
+                wait = start + k / rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            sent = time.perf_counter()
+            seq = peers[origin].moneyTransfer(from_id, to_id, 1)
+            if seq is not None:
+                submitted[(origin, seq)] = sent
+        deadline = time.perf_counter() + timeout
+        while len(committed) < len(submitted) and time.perf_counter() < deadline:
+            if not any(p.pending or p.rounds or p.forwarded for p in peers.values()):
+                break
+            time.sleep(0.01)
+        # Followers may still be applying the last decisions
+        while len({p.blockchain.len for p in peers.values()}) > 1 and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+    with commit_lock:
+        done = dict(committed)
+        reported = outcomes["committed"]
+    latencies = sorted(done[key] - submitted[key] for key in done if key in submitted)
+    elapsed = (max(done.values()) if done else time.perf_counter()) - start
+    blocks = max(p.blockchain.len for p in peers.values())
+    frames = sum(p.counters()["frames_sent"] for p in peers.values())
+    results = {
+        "submitted": len(submitted),
+        "committed": len(latencies),
+        "blocks": blocks,
+        "elapsed_s": elapsed,
+        "commits_per_s": len(latencies) / elapsed,
+        "blocks_per_s": blocks / elapsed,
+        "frames_per_block": frames / blocks if blocks else None,
+        "escalations": sum(p.counters()["thrifty_escalations"] for p in peers.values()),
+        "retries": sum(p.counters()["round_retries"] for p in peers.values()),
+        "latency_ms": {f"p{p:g}".replace(".", ""): percentile(latencies, p) * 1000 if latencies else None for p in (50, 99, 99.9)},
+        **check_replicas(peers, reported),
+    }
+    if net is not None:
+        results["virtual_s"] = net.now
+        results["network"] = dict(net.stats)
+
+    rate_text = f"{rate:,} transfers/s" if rate else "all at once"
+    print(f"Cluster ({transport}, {config.size} peers{', thrifty' if thrifty else ''}{'' if stable_leader else ', no stable leader'}): {transfers:,} transfers '{mode}', {rate_text}, batch {batch_size}, window {window}, {len(config.accounts):,} accounts")
+    print(f"{len(latencies):,} of {len(submitted):,} committed in {blocks:,} blocks, {elapsed:.2f}s: {results['commits_per_s']:,.0f} commits/s, {results['blocks_per_s']:,.0f} blocks/s")
+    if latencies:
+        p = results["latency_ms"]
+        print(f"commit latency: p50 {p['p50']:.1f} ms, p99 {p['p99']:.1f} ms, p999 {p['p999']:.1f} ms")
+    if blocks:
+        print(f"{results['frames_per_block']:.1f} frames per block, {results['escalations']} thrifty escalations, {results['retries']} round retries")
+    if net is not None:
+        print(f"{net.now:.2f}s virtual, {net.stats}")
+    if results["consistent"]:
+        print(f"Replicas agree on {blocks:,} blocks and the account table; {reported:,} committed outcomes for {results['chain_transfers']:,} transfers on the chain")
+    else:
+        print(f"Replicas disagree: same chain {results['same_chain']}, same table {results['same_table']}, {reported:,} committed outcomes for {results['chain_transfers']:,} transfers on the chain")
+    return results
+
+def bench_suite():
+    # Short runs of everything, for comparing versions; the clusters run on the simulated network
+    results = {
+        "pow": bench_pow(1, 2, 20),
+        "chain": bench_chain(100_000),
+        "block": bench_block(20_000, 32),
+        "verify": bench_verify(1, 20_000, 32),
+        "storage": bench_storage(20_000, 32),
+        "wire": bench_wire(32, 2_000),
+    }
+    for mode in ("single", "all", "hot"):
+        results[f"cluster_{mode}"] = bench_cluster(mode, 2_000, 0, "sim", 32, 4, 0.001, 0.0, 10**6, 30)
+    return results
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit') or old_path} -> {new.get('commit') or new_path}")
+    old_flat = flatten(old["results"])
+    new_flat = flatten(new["results"])
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        before, after = old_flat[key], new_flat[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{key:40s} {before:14,.2f} {after:14,.2f} {change:>8s}")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    parser.add_argument("--out", type=str, default=None, help="write the results to this JSON file")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    pow_parser = sub.add_parser("pow", help="hashes per second of the nonce search")
+    pow_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    pow_parser.add_argument("--zeros", type=int, default=4)
+    pow_parser.add_argument("--blocks", type=int, default=20)
+
+    chain_parser = sub.add_parser("chain", help="memory and access time of the chain store")
+    chain_parser.add_argument("--blocks", type=int, default=1_000_000)
+
+    block_parser = sub.add_parser("block", help="time to verify one block against the one before it")
+    block_parser.add_argument("--blocks", type=int, default=100_000)
+    block_parser.add_argument("--batch", type=int, default=32)
+
+    verify_parser = sub.add_parser("verify", help="blocks per second of full chain verification")
+    verify_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    verify_parser.add_argument("--blocks", type=int, default=200_000)
+    verify_parser.add_argument("--batch", type=int, default=32)
+
+    storage_parser = sub.add_parser("storage", help="time to write and load a state file")
+    storage_parser.add_argument("--blocks", type=int, default=100_000)
+    storage_parser.add_argument("--batch", type=int, default=32)
+
+    wire_parser = sub.add_parser("wire", help="encode/decode cost and size of JSON and binary messages")
+    wire_parser.add_argument("--batch", type=int, default=32)
+    wire_parser.add_argument("--rounds", type=int, default=20_000)
+
+    cluster_parser = sub.add_parser("cluster", help="commits per second and commit latency of a local cluster")
+    cluster_parser.add_argument("--peers", type=int, default=5)
+    cluster_parser.add_argument("--thrifty", action=argparse.BooleanOptionalAction, default=False)
+    cluster_parser.add_argument("--stable-leader", action=argparse.BooleanOptionalAction, default=True)
+    cluster_parser.add_argument("--accounts", type=int, default=None, help="accounts in the table, one per peer by default")
+    cluster_parser.add_argument("--mode", choices=["single", "all", "hot"], default="all")
+    cluster_parser.add_argument("--transfers", type=int, default=5000)
+    cluster_parser.add_argument("--rate", type=float, default=0, help="transfers per second, 0 for all at once")
+    cluster_parser.add_argument("--transport", choices=["sim", "tcp", "asyncio"], default="sim")
+    cluster_parser.add_argument("--batch", type=int, default=32)
+    cluster_parser.add_argument("--window", type=int, default=4)
+    cluster_parser.add_argument("--latency", type=float, default=0.001, help="one way latency of the simulated network")
+    cluster_parser.add_argument("--drop", type=float, default=0.0, help="chance that the simulated network drops a frame")
+    cluster_parser.add_argument("--delay", type=float, default=0.0, help="network delay of the tcp and asyncio transports")
+    cluster_parser.add_argument("--balance", type=int, default=10**6)
+    cluster_parser.add_argument("--timeout", type=float, default=60)
+
+    sub.add_parser("suite", help="short runs of every benchmark")
+
+    compare_parser = sub.add_parser("compare", help="compare two result files written with --out")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    match args.bench:
+        case "pow":
+            results = bench_pow(args.workers, args.zeros, args.blocks)
+        case "chain":
+            results = bench_chain(args.blocks)
+        case "block":
+            results = bench_block(args.blocks, args.batch)
+        case "verify":
+            results = bench_verify(args.workers, args.blocks, args.batch)
+        case "storage":
+            results = bench_storage(args.blocks, args.batch)
+        case "wire":
+            results = bench_wire(args.batch, args.rounds)
+        case "cluster":
+            results = bench_cluster(args.mode, args.transfers, args.rate, args.transport, args.batch, args.window, args.latency, args.drop, args.balance, args.timeout, args.delay, args.peers, args.thrifty, args.stable_leader, args.accounts)
+        case "suite":
+            results = bench_suite()
+        case "compare":
+            compare(args.old, args.new)
+            return
+
+    if args.out:
+        report = {
+            "bench": args.bench,
+            "args": {k: v for k, v in vars(args).items() if k not in ("bench", "out")},
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+        }
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,177 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import multiprocessing
 import hashlib
-import random
-import string
 import json
 
+# A hash is accepted when it ends in one of `suffix` and starts with `zeros` zeros
+difficulty = {"suffix": "01234", "zeros": 0}
+NONCE_CHUNK = 4096
+# Proposers start their nonce search at a random counter below this, so two of them batching the same
+# transfers at the same depth still build different blocks. Nonces stay 8 hex digits.
+NONCE_START_LIMIT = 1 << 31
+VERIFY_CHUNK = 4096
+# Blocks read from a chain file that are kept materialised
+STORED_CACHE = 4096
+_pools = {}
+
 def sha256(data):
     return hashlib.sha256(data.encode()).hexdigest()
 
-def sha256_transaction(transaction, nonce):
-    s = json.dumps(transaction, separators=(',', ':')) + nonce
-    return hashlib.sha256(s.encode()).hexdigest()
+def normalize_transaction(transaction):
+    if transaction and isinstance(transaction[0], (list, tuple)):
+        return [tuple(tx) for tx in transaction]
+    return tuple(transaction)
+
+def transactions_of(transaction):
+    # Blocks written before batching hold a single (from, to, amount) tuple
+    if transaction and isinstance(transaction[0], (list, tuple)):
+        return [tuple(tx) for tx in transaction]
+    return [tuple(transaction)]
+
+def canonical_encoding(transaction):
+    return json.dumps(transaction, separators=(',', ':')).encode()
+
+def sha256_transaction(transaction, nonce, encoding=None):
+    if encoding is None:
+        encoding = canonical_encoding(transaction)
+    return hashlib.sha256(encoding + nonce.encode()).hexdigest()
+
+def block_digest(encoding, nonce, hash_value):
+    return hashlib.sha256(encoding + nonce.encode() + hash_value.encode()).hexdigest()
+
+def verify_records(records, prev_digest):
+    # records are (transaction, encoding or None, nonce, hash_value, hash_pointer); each block only
+    # needs the digest of the one before it, so a chain splits into ranges that verify independently
+    for transaction, encoding, nonce, hash_value, hash_pointer in records:
+        if encoding is None:
+            encoding = canonical_encoding(transaction)
+        if hash_value != sha256_transaction(transaction, nonce, encoding) or hash_pointer != prev_digest:
+            return False
+        prev_digest = block_digest(encoding, nonce, hash_value)
+    return True
+
+def set_difficulty(suffix="01234", zeros=0):
+    difficulty["suffix"] = suffix
+    difficulty["zeros"] = zeros
+
+def search_nonce(prefix, start, stop, suffix, zeros):
+    # Nonces are the hex form of a counter; the serialised transaction is hashed only once
+    base = hashlib.sha256(prefix)
+    leading = "0" * zeros
+    for counter in range(start, stop):
+        nonce = format(counter, "08x")
+        h = base.copy()
+        h.update(nonce.encode())
+        digest = h.hexdigest()
+        if digest[-1] in suffix and digest.startswith(leading):
+            return nonce, digest
+    return None
 
-def generate_hash(transaction):
+def _pool(workers):
+    if workers not in _pools:
+        # Peers are multi-threaded by the time they mine, so workers are spawned rather than forked
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pools[workers]
+
+def generate_hash(transaction, workers=1, encoding=None, start=0):
+    prefix = canonical_encoding(transaction) if encoding is None else encoding
+    suffix, zeros = difficulty["suffix"], difficulty["zeros"]
+
+    if workers <= 1:
+        while True:
+            found = search_nonce(prefix, start, start + NONCE_CHUNK, suffix, zeros)
+            if found:
+                return found
+            start += NONCE_CHUNK
+
+    # Each round hands one chunk of the counter space to every worker. Taking the hit from
+    # the lowest chunk gives the same nonce as a sequential search from `start`, whatever the worker count.
+    pool = _pool(workers)
     while True:
-        nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-        h = sha256_transaction(transaction, nonce)
-        if h[-1] in '01234': 
-            return nonce, h
+        futures = [pool.submit(search_nonce, prefix, start + i * NONCE_CHUNK, start + (i + 1) * NONCE_CHUNK, suffix, zeros)
+                   for i in range(workers)]
+        for future in futures:
+            found = future.result()
+            if found:
+                for rest in futures:
+                    rest.cancel()
+                return found
+        start += workers * NONCE_CHUNK
+
+def pointer_digest(block):
+    if block is None:
+        return None
+    return block.digest
 
 class Block:
-    def __init__(self, transaction, previous=None):
-        self.transaction = transaction
-        self.nonce, self.hash_value = generate_hash(transaction)
-        self.prev = previous
-        self.next = None
-        if previous:
-            prev_data = json.dumps(previous.transaction, separators=(',', ':')) + previous.nonce + previous.hash_value
-            self.hash_pointer = sha256(prev_data)
-        else:
-            self.hash_pointer = None
+    # Once appended, a block finds its neighbours through its chain and position, so it holds no links of its own.
+    # Blocks are not changed after construction, which lets the encoding and digest be cached.
+    __slots__ = ("transaction", "nonce", "hash_value", "hash_pointer", "_prev", "_chain", "_index", "_encoding", "_digest")
+
+    def __init__(self, transaction, previous=None, workers=1):
+        self.transaction = normalize_transaction(transaction)
+        self._encoding = canonical_encoding(self.transaction)
+        self._digest = None
+        self.nonce, self.hash_value = generate_hash(self.transaction, workers, self._encoding)
+        self.hash_pointer = pointer_digest(previous)
+        self._prev = previous
+        self._chain = None
+        self._index = 0
 
     @classmethod
-    def reconstruct(cls, tx, nonce, hash_value, prev, hash_pointer):
+    def reconstruct(cls, tx, nonce, hash_value, prev, hash_pointer, encoding=None):
+        # `encoding` may be passed when the caller already serialised the same transaction
         obj = cls.__new__(cls)
-        obj.transaction = tx
+        obj.transaction = normalize_transaction(tx)
+        obj._encoding = encoding
+        obj._digest = None
         obj.nonce = nonce
         obj.hash_value = hash_value
-        obj.prev = prev
-        obj.next = None
         obj.hash_pointer = hash_pointer
+        obj._prev = prev
+        obj._chain = None
+        obj._index = 0
         return obj
 
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = canonical_encoding(self.transaction)
+        return self._encoding
+
+    @property
+    def digest(self):
+        # The value the next block's hash_pointer must match
+        if self._digest is None:
+            self._digest = block_digest(self.encoding, self.nonce, self.hash_value)
+        return self._digest
+
+    @property
+    def prev(self):
+        if self._chain is None:
+            return self._prev
+        return self._chain._block(self._index - 1) if self._index > 0 else None
+
+    @prev.setter
+    def prev(self, block):
+        self._prev = block
+
+    @property
+    def next(self):
+        if self._chain is None:
+            return None
+        return self._chain._block(self._index + 1) if self._index + 1 < self._chain.len else None
+
+    def verify_hash(self):
+        return self.hash_value == sha256_transaction(self.transaction, self.nonce, self.encoding)
+
     def verify(self, prev_block=None):
-        expected_hash = sha256_transaction(self.transaction, self.nonce)
-        if self.hash_value != expected_hash:
+        if not self.verify_hash():
             return False
 
         if prev_block:
-            prev_data = json.dumps(prev_block.transaction, separators=(',', ':')) + prev_block.nonce + prev_block.hash_value
-            expected_pointer = sha256(prev_data)
-            if self.hash_pointer != expected_pointer:
+            if self.hash_pointer != pointer_digest(prev_block):
                 return False
         elif self.hash_pointer is not None:
             return False
@@ -61,73 +184,107 @@ class Block:
                 f"PrevHash={self.hash_pointer if self.hash_pointer else None})")
 
 class BlockChain:
-    def __init__(self):
-        self.len = 0
-        self.head = None
-        self.tail = None
-
-    def new_block(self, transaction):
-        if self.len == 0:
-            new_block = Block(transaction)
-        else:
-            new_block = Block(transaction, self.tail)
-        return new_block
+    # The first blocks may come from `store`, a chainfile.ChainFile; those are materialised when
+    # first used and only the most recent STORED_CACHE of them are kept. Appended blocks stay in memory.
+    def __init__(self, store=None):
+        self._store = store
+        self._base = len(store) if store is not None else 0
+        self._blocks = []
+        if store is not None:
+            self._stored = functools.lru_cache(maxsize=STORED_CACHE)(self._materialise)
+
+    def _materialise(self, i):
+        record = self._store.record(i)
+        block = Block.reconstruct(record["transaction"], record["nonce"], record["hash_value"], None, record["hash_pointer"])
+        block._chain = self
+        block._index = i
+        return block
+
+    def _block(self, i):
+        return self._stored(i) if i < self._base else self._blocks[i - self._base]
+
+    @property
+    def len(self):
+        return self._base + len(self._blocks)
+
+    @property
+    def head(self):
+        return self._block(0) if self.len else None
+
+    @property
+    def tail(self):
+        return self._block(self.len - 1) if self.len else None
+
+    def new_block(self, transaction, workers=1):
+        return Block(transaction, self.tail, workers)
 
     def append(self, block):
-        if self.len == 0:
-            self.head = self.tail = block
-        else:
-            self.tail.next = block
-            self.tail = block
-        self.len += 1
+        block._prev = None
+        block._chain = self
+        block._index = self.len
+        self._blocks.append(block)
 
     def get_tail(self):
         return self.tail
 
-    def verify(self):
-        current = self.head
-        prev = None
-        while current:
-            if not current.verify(prev):
-                return False
-            prev = current
-            current = current.next
-        return True
+    def blocks(self, start=0, stop=None):
+        # Yields blocks[start:stop] without copying; appends made meanwhile are not included
+        stop = self.len if stop is None else min(stop, self.len)
+        for i in range(start, stop):
+            yield self._block(i)
+
+    def verify(self, workers=1, start=0):
+        # Checks blocks[start:]; the blocks before `start` are trusted
+        if workers <= 1 or self.len - start <= VERIFY_CHUNK:
+            prev = self._block(start - 1) if start > 0 else None
+            for block in self.blocks(start):
+                if not block.verify(prev):
+                    return False
+                prev = block
+            return True
+
+        pool = _pool(workers)
+        futures = []
+        for lo in range(start, self.len, VERIFY_CHUNK):
+            records = [(b.transaction, b._encoding, b.nonce, b.hash_value, b.hash_pointer) for b in self.blocks(lo, lo + VERIFY_CHUNK)]
+            futures.append(pool.submit(verify_records, records, self._block(lo - 1).digest if lo > 0 else None))
+        valid = True
+        for future in futures:
+            if not future.result():
+                valid = False
+                for rest in futures:
+                    rest.cancel()
+                break
+        return valid
 
     def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self._block(i) for i in range(*n.indices(self.len))]
         if n < 0:
             n += self.len
-        if n < 0 or n >= self.len:
-            raise IndexError
-        block = self.head
-        for _ in range(n):
-            block = block.next
-        return block
+        if not 0 <= n < self.len:
+            raise IndexError("blockchain index out of range")
+        return self._block(n)
+
+    def __len__(self):
+        return self.len
 
     def __repr__(self):
-        s = ""
-        block = self.head
-        for i in range(self.len):
-            s += repr(block) + ('' if i == self.len-1 else '\n')
-            block = block.next
-        return s
+        return "\n".join(map(repr, self.blocks()))
 
     def __iter__(self):
-        current = self.head
-        while current:
-            yield current
-            current = current.next
-    
+        return self.blocks()
+
 def main():
     bc = BlockChain()
 
-    b1 = bc.new_block((1,2,10))
+    b1 = bc.new_block([(1,2,10)])
     bc.append(b1)
 
-    b2 = bc.new_block((1,2,20))
+    b2 = bc.new_block([(1,2,20), (2,3,5)])
     bc.append(b2)
     
-    b3 = bc.new_block((1,2,30))
+    b3 = bc.new_block([(1,2,30)])
     bc.append(b3)
 
 
@@ -0,0 +1,184 @@
+import json
+import mmap
+import os
+import struct
+import wire
+
+# c_<id>.chain is a header followed by one record per block: a 4-byte length, a kind byte and the
+# block in the wire layout, or as JSON when its transfers do not fit that layout. c_<id>.idx is a
+# header followed by the end offset of every record as a fixed 8-byte entry, so block i is found
+# without reading the blocks before it. Both headers carry the same generation, which changes
+# whenever the chain is rewritten, so an index left over from another chain is never trusted.
+MAGIC = b"PXCHAIN1"
+HEADER = struct.Struct(">8sQ")     # magic, generation
+LENGTH = struct.Struct(">I")
+OFFSET = struct.Struct(">Q")
+RECORD_JSON = 0
+RECORD_BINARY = 1
+
+def index_path(chain_path):
+    return os.path.splitext(chain_path)[0] + ".idx"
+
+def is_chain_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+def encode_record(block):
+    try:
+        payload = bytes([RECORD_BINARY]) + wire.encode_block(block.transaction, block.nonce, block.hash_value, block.hash_pointer)
+    except (ValueError, TypeError, struct.error):
+        fields = {"transaction": block.transaction, "nonce": block.nonce, "hash_value": block.hash_value, "hash_pointer": block.hash_pointer}
+        payload = bytes([RECORD_JSON]) + json.dumps(fields).encode()
+    return LENGTH.pack(len(payload)) + payload
+
+def decode_record(payload):
+    if payload[0] == RECORD_BINARY:
+        return wire.decode_block(payload[1:])
+    return json.loads(bytes(payload[1:]))
+
+def _fsync_write(path, data, mode):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_chain(path, blocks):
+    # Replaces the chain and its index; the index is renamed into place last
+    generation = int.from_bytes(os.urandom(8), "big")
+    header = HEADER.pack(MAGIC, generation)
+    records, ends = [], []
+    offset = HEADER.size
+    for block in blocks:
+        record = encode_record(block)
+        offset += len(record)
+        records.append(record)
+        ends.append(OFFSET.pack(offset))
+    idx_path = index_path(path)
+    _fsync_write(path + ".tmp", header + b"".join(records), "wb")
+    _fsync_write(idx_path + ".tmp", header + b"".join(ends), "wb")
+    os.replace(path + ".tmp", path)
+    os.replace(idx_path + ".tmp", idx_path)
+
+def append_blocks(path, blocks):
+    # Only the chain is fsynced; an index entry lost in a crash is rebuilt from the chain on open
+    with open(path, "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        ends = []
+        for block in blocks:
+            record = encode_record(block)
+            f.write(record)
+            offset += len(record)
+            ends.append(OFFSET.pack(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    with open(index_path(path), "ab") as f:
+        f.write(b"".join(ends))
+
+def sync_index(path):
+    # Called before a checkpoint counts the index entries as durable
+    idx_path = index_path(path)
+    if os.path.isfile(idx_path):
+        with open(idx_path, "ab") as f:
+            os.fsync(f.fileno())
+
+class ChainFile:
+    # Read-only view of the blocks on disk when it was opened. The first `trusted` index entries are
+    # taken as they are; the entries after them are checked against the chain and rebuilt from it
+    # where a crash cut them off, and a torn record at the end of the chain is cut off.
+    def __init__(self, path, trusted=0):
+        self.path = path
+        self.idx_path = index_path(path)
+        with open(path, "r+b") as chain:
+            header = chain.read(HEADER.size)
+            magic, _ = HEADER.unpack(header) if len(header) == HEADER.size else (None, None)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a chain file")
+            chain_size = os.fstat(chain.fileno()).st_size
+            with mmap.mmap(chain.fileno(), 0, access=mmap.ACCESS_READ) as chain_map:
+                kept, ends = self._check_index(chain_map, chain_size, header, trusted)
+            self.count = (kept or 0) + len(ends)
+            self.chain_size = ends[-1] if ends else self._end(kept or 0)
+            if self.chain_size != chain_size:
+                chain.truncate(self.chain_size)
+                os.fsync(chain.fileno())
+        if kept is None or ends:
+            # Only the entries after the ones kept are written again
+            with open(self.idx_path, "r+b" if kept is not None else "wb") as f:
+                if kept is None:
+                    f.write(header)
+                else:
+                    f.truncate(HEADER.size + 8 * kept)
+                    f.seek(0, os.SEEK_END)
+                f.write(b"".join(OFFSET.pack(end) for end in ends))
+                f.flush()
+                os.fsync(f.fileno())
+        with open(path, "rb") as chain:
+            self.chain = mmap.mmap(chain.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = self._map_index() if self.count else None
+
+    def _end(self, kept):
+        # End offset of the last kept record, read from the index file
+        if not kept:
+            return HEADER.size
+        with open(self.idx_path, "rb") as f:
+            f.seek(HEADER.size + 8 * (kept - 1))
+            return OFFSET.unpack(f.read(8))[0]
+
+    def _check_index(self, chain_map, chain_size, header, trusted):
+        # Returns how many index entries are kept as they are (None when the index file has to be
+        # written from scratch) and the end offsets of the records after them
+        try:
+            with open(self.idx_path, "rb") as f:
+                if f.read(HEADER.size) != header:
+                    raise FileNotFoundError
+                size = os.fstat(f.fileno()).st_size
+                kept = min(trusted, (size - HEADER.size) // 8)
+                f.seek(HEADER.size + 8 * (kept - 1) if kept else HEADER.size)
+                offset = OFFSET.unpack(f.read(8))[0] if kept else HEADER.size
+                rest = f.read()
+        except FileNotFoundError:
+            kept, offset, rest = None, HEADER.size, b""
+        # Entries past the trusted ones must each end the record that starts where the last one ended
+        for (end,) in OFFSET.iter_unpack(rest[:len(rest) - len(rest) % 8]):
+            if not self._record_ends(chain_map, chain_size, offset, end):
+                break
+            kept += 1
+            offset = end
+        ends = []
+        # Records the index does not cover, up to the first torn one
+        while offset + LENGTH.size <= chain_size:
+            length = LENGTH.unpack_from(chain_map, offset)[0]
+            end = offset + LENGTH.size + length
+            if length == 0 or end > chain_size:
+                break
+            ends.append(end)
+            offset = end
+        if kept is not None and not ends and (size - HEADER.size) != 8 * kept:
+            # Nothing to add, but entries past the kept ones are cut off
+            with open(self.idx_path, "r+b") as f:
+                f.truncate(HEADER.size + 8 * kept)
+                os.fsync(f.fileno())
+        return kept, ends
+
+    def _record_ends(self, chain_map, chain_size, offset, end):
+        if offset + LENGTH.size > chain_size or end > chain_size:
+            return False
+        return offset + LENGTH.size + LENGTH.unpack_from(chain_map, offset)[0] == end
+
+    def _map_index(self):
+        with open(self.idx_path, "rb") as f:
+            return mmap.mmap(f.fileno(), HEADER.size + 8 * self.count, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        # The fields of block i as a dict, in the form dict_from_block gives
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start = OFFSET.unpack_from(self.index, HEADER.size + 8 * (i - 1))[0] if i else HEADER.size
+        end = OFFSET.unpack_from(self.index, HEADER.size + 8 * i)[0]
+        return decode_record(memoryview(self.chain)[start + LENGTH.size:end])
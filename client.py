@@ -1,6 +1,13 @@
 from peer import Peer
+from blockchain import set_difficulty
+from metrics import Histogram
+from config import load_config
 import argparse
+import json
 import re
+import sys
+import threading
+import time
 
 alias_table = {
     "fail": "failprocess",
@@ -8,14 +15,114 @@ alias_table = {
     "mt": "moneytransfer",
     "bal": "printbalance",
     "blocks": "printblockchain",
-    "debug": "debugmessage"
+    "debug": "debugmessage",
+    "stats": "printstats",
+    "metrics": "printmetrics",
+    "run": "runscript",
+    "balat": "balanceat",
+    "hist": "history",
+    "audit": "auditbalances",
+    "pending": "printpending"
 }
 
-def main(id, debug, load):
-    p = Peer(id, debug, load)
+def run_script(p, path, outstanding=64, timeout=30, results=None):
+    # Replays transfers from a JSONL file ("-" for stdin), one {"from": 1, "to": 2, "amount": 5}
+    # per line with an optional "id", keeping at most `outstanding` of them uncommitted.
+    # Writes one JSON line per transfer with its outcome (committed, rejected, unknown, invalid,
+    # timeout or malformed) and latency, then a summary.
+    source = sys.stdin if path == "-" else open(path)
+    out = open(results, "w") if results else sys.stdout
+    cv = threading.Condition()
+    pending = {}
+    outcomes = {}
+    latency = Histogram()
+
+    def record(line_no, req_id, outcome, seconds=None):
+        # Caller holds cv
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        entry = {"line": line_no, "id": req_id, "outcome": outcome}
+        if seconds is not None:
+            latency.observe(seconds)
+            entry["latency_ms"] = round(seconds * 1000, 3)
+        out.write(json.dumps(entry) + "\n")
+
+    def settled(seq, outcome):
+        # The peer reports committed, rejected, or unknown when it gave up on the transfer
+        now = time.perf_counter()
+        with cv:
+            entry = pending.pop(seq, None)
+            if entry is not None:
+                record(entry[0], entry[1], outcome, now - entry[2] if outcome == "committed" else None)
+                cv.notify_all()
+
+    def expire():
+        # Caller holds cv
+        now = time.perf_counter()
+        for seq in [seq for seq, entry in pending.items() if now - entry[2] > timeout]:
+            line_no, req_id, _ = pending.pop(seq)
+            record(line_no, req_id, "timeout")
+
+    p.on_outcome = settled
+    started = time.perf_counter()
+    try:
+        for line_no, line in enumerate(source, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                req = json.loads(line)
+                req_id = req.get("id")
+                transfer = (int(req["from"]), int(req["to"]), int(req["amount"]))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                with cv:
+                    record(line_no, None, "malformed")
+                continue
+            with cv:
+                while len(pending) >= outstanding:
+                    expire()
+                    cv.wait(0.1)
+                # Registered under cv, so the commit cannot be reported before it is tracked
+                sent = time.perf_counter()
+                seq = p.moneyTransfer(*transfer)
+                if seq is None:
+                    record(line_no, req_id, "invalid")
+                else:
+                    pending[seq] = (line_no, req_id, sent)
+        with cv:
+            while pending:
+                expire()
+                cv.wait(0.1)
+    finally:
+        p.on_outcome = None
+        if source is not sys.stdin:
+            source.close()
+        if results:
+            out.close()
+        else:
+            out.flush()
+
+    elapsed = time.perf_counter() - started
+    summary = ", ".join(f"{outcome} {n}" for outcome, n in sorted(outcomes.items()))
+    print(f"Script {path}: {summary} in {elapsed:.2f}s ({outcomes.get('committed', 0) / elapsed:,.0f} commits/s)")
+    if latency.n:
+        print(f"Commit latency: p50 {latency.quantile(0.5) * 1000:.0f} ms, p99 {latency.quantile(0.99) * 1000:.0f} ms, max {latency.max * 1000:.0f} ms")
+
+def start_script(p, path, options):
+    try:
+        run_script(p, path, options.outstanding, options.request_timeout, options.results)
+    except OSError as e:
+        print(f"Could not run script: {e}")
+
+def main(options, debug, config):
+    p = Peer(options.id, debug, options.load, batch_size=options.batch_size, batch_linger=options.batch_linger, stable_leader=options.stable_leader, window=options.window, pow_workers=options.pow_workers, wire=options.wire, runtime=options.runtime, network_delay=options.network_delay, metrics=options.metrics or options.metrics_port is not None, config=config, thrifty=options.thrifty, max_pending=options.max_pending)
+    if options.metrics_port is not None:
+        p.metrics.serve(options.metrics_port, p.counters)
+    if options.script is not None:
+        start_script(p, options.script, options)
 
     while True:
-        cmd = input().lower()
+        raw = input()
+        cmd = raw.lower()
         cmd = alias_table.get(cmd, cmd)
         if p.dead and cmd != "fixprocess": 
             print("This process is dead.")
@@ -36,6 +143,18 @@ def main(id, debug, load):
             case "printbalance":
                 p.print_table()
 
+            case "printstats":
+                p.print_stats()
+
+            case "printmetrics":
+                p.print_metrics()
+
+            case "auditbalances":
+                p.print_audit()
+
+            case "printpending":
+                p.print_pending()
+
             case _:
                 pattern = r'(\w+)\((.*?)\)'
                 parse = re.match(pattern, cmd)
@@ -45,9 +164,19 @@ def main(id, debug, load):
                     if cmd_root == "moneytransfer":
                         p.moneyTransfer(args[0], args[1], args[2])
                         continue
+                    elif cmd_root == "balanceat" and len(args) == 2:
+                        p.print_balance_at(args[0], args[1])
+                        continue
+                    elif cmd_root == "history" and len(args) in (1, 2):
+                        p.print_history(*args)
+                        continue
                     elif cmd_root == "debugmessage" and debug:
                         p.send(int(args[0]), {"type": "DEBUG", "from": p.id, "text": args[1]})
                         continue
+                    elif cmd_root == "runscript":
+                        # File names keep their case
+                        start_script(p, re.match(pattern, raw.strip()).group(2).strip(), options)
+                        continue
                 print("Unknown Command")
 
 if __name__ == "__main__":
@@ -55,8 +184,32 @@ if __name__ == "__main__":
     parser.add_argument("--id", type=int, required=True)
     parser.add_argument("--load", type=bool, required=False, default=False)
     parser.add_argument("--debug", type=str, required=False, default='None')
+    parser.add_argument("--batch-size", type=int, required=False, default=32)
+    parser.add_argument("--batch-linger", type=float, required=False, default=0.05)
+    parser.add_argument("--stable-leader", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--window", type=int, required=False, default=4)
+    parser.add_argument("--pow-workers", type=int, required=False, default=1)
+    parser.add_argument("--pow-suffix", type=str, required=False, default="01234")
+    parser.add_argument("--pow-zeros", type=int, required=False, default=0)
+    parser.add_argument("--wire", type=str, choices=["binary", "json"], required=False, default="binary")
+    parser.add_argument("--runtime", type=str, choices=["threads", "asyncio"], required=False, default="threads")
+    parser.add_argument("--network-delay", type=float, required=False, default=3)
+    parser.add_argument("--metrics", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--metrics-port", type=int, required=False, default=None)
+    parser.add_argument("--script", type=str, required=False, default=None)
+    parser.add_argument("--outstanding", type=int, required=False, default=64)
+    parser.add_argument("--request-timeout", type=float, required=False, default=30)
+    parser.add_argument("--results", type=str, required=False, default=None)
+    parser.add_argument("--config", type=str, required=False, default=None)
+    parser.add_argument("--peers", type=int, required=False, default=None)
+    parser.add_argument("--thrifty", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--max-pending", type=int, required=False, default=10000)
     args = parser.parse_args()
 
+    config = load_config(args.config, args.peers)
+    if args.id not in config.members:
+        parser.error(f"--id {args.id} is not a member of the cluster {sorted(config.members)}")
+
     debug = args.debug.lower()
     debug_num = 0
     match debug:
@@ -69,4 +222,5 @@ if __name__ == "__main__":
         case _:
             debug_num = 0
 
-    main(args.id, debug_num, args.load)
+    set_difficulty(args.pow_suffix, args.pow_zeros)
+    main(args, debug_num, config)
@@ -0,0 +1,63 @@
+import argparse
+import json
+
+DEFAULT_PEERS = 5
+INITIAL_BALANCE = 100
+
+class ClusterConfig:
+    # Who is in the cluster and where they listen. A JSON file looks like
+    #   {"members": {"1": "10.0.0.1:1234", "2": "10.0.0.2:1234", ...}, "accounts": 5, "balance": 100}
+    # where accounts defaults to one per member. Quorums are majorities of the members.
+    def __init__(self, members, accounts=None, balance=INITIAL_BALANCE):
+        self.members = {int(id): (host, int(port)) for id, (host, port) in members.items()}
+        if not self.members:
+            raise ValueError("A cluster needs at least one member")
+        self.accounts = list(range(1, (len(self.members) if accounts is None else int(accounts)) + 1))
+        self.balance = balance
+
+    @classmethod
+    def local(cls, n=DEFAULT_PEERS, accounts=None, host="127.0.0.1"):
+        # Members 1..n on one host, each listening on port id*1234
+        return cls({i: (host, i * 1234) for i in range(1, n + 1)}, accounts)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        members = {}
+        for id, address in data["members"].items():
+            host, _, port = address.rpartition(":")
+            members[id] = (host, port)
+        return cls(members, data.get("accounts"), data.get("balance", INITIAL_BALANCE))
+
+    @property
+    def size(self):
+        return len(self.members)
+
+    @property
+    def quorum(self):
+        return self.size // 2 + 1
+
+    def others(self, id):
+        return [i for i in self.members if i != id]
+
+    def address(self, id):
+        return self.members[id]
+
+    def genesis(self):
+        return {account: self.balance for account in self.accounts}
+
+def load_config(path=None, peers=None):
+    # A config file wins; otherwise a local cluster of `peers` members
+    if path is not None:
+        return ClusterConfig.load(path)
+    return ClusterConfig.local(peers or DEFAULT_PEERS)
+
+if __name__ == "__main__":
+    # Prints "id host port" per member, for scripts such as the Makefile
+    parser = argparse.ArgumentParser(description="Cluster config")
+    parser.add_argument("--config", type=str, required=False, default=None)
+    parser.add_argument("--peers", type=int, required=False, default=None)
+    args = parser.parse_args()
+    for id, (host, port) in load_config(args.config, args.peers).members.items():
+        print(id, host, port)
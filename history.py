@@ -0,0 +1,106 @@
+from blockchain import transactions_of
+from utils import net_effect, history_paths, read_history, read_snapshots
+from collections import Counter, defaultdict
+import bisect
+
+# Without a state file, a full copy of the balances is kept every SNAPSHOT_EVERY blocks
+SNAPSHOT_EVERY = 256
+
+class BalanceHistory:
+    # Balances over the chain without walking it. Every block that moves an account's money adds
+    # its depth and the account's balance after it to that account's index, so a balance at a depth
+    # is one bisect and a history is a slice; only the blocks in the slice are read for their transfers.
+    # Snapshots of the whole table are what audit() checks the index against. A peer with a state
+    # file reads the index back from the files its state log appends, and the snapshots are the
+    # tables of its checkpoints; without one, a snapshot is kept in memory every `every` blocks.
+    def __init__(self, genesis, every=SNAPSHOT_EVERY, snapshot_path=None):
+        self.genesis = dict(genesis)
+        self.every = every
+        self.snapshot_path = snapshot_path
+        self.depth = 0
+        self.snapshots = {} if snapshot_path else {0: dict(genesis)}
+        self.depths = defaultdict(list)
+        self.balances = defaultdict(list)
+        # Balances after the last block recorded, kept apart from the peer's table
+        self.table = dict(genesis)
+
+    @classmethod
+    def load(cls, path, genesis, depth):
+        # The index of blocks 1..depth, as far as the history file of the state file at `path` holds it
+        hist_path, snap_path = history_paths(path)
+        history = cls(genesis, snapshot_path=snap_path)
+        for d, balances in read_history(hist_path, depth):
+            history.record(d, balances)
+        return history
+
+    def extend(self, blockchain, depth):
+        # Replays the blocks after the last one recorded, up to `depth`, and returns what it recorded
+        replayed = []
+        for d, block in enumerate(blockchain.blocks(self.depth, depth), start=self.depth + 1):
+            effect, _ = net_effect(self.table.get, transactions_of(block.transaction))
+            balances = {account: self.table[account] + change for account, change in effect.items()}
+            self.record(d, balances)
+            replayed.append((d, balances))
+        return replayed
+
+    def record(self, depth, balances):
+        # balances holds the balance after block `depth` of every account the block moved money for
+        depths, history = self.depths, self.balances
+        for account, balance in balances.items():
+            depths[account].append(depth)
+            history[account].append(balance)
+        self.table.update(balances)
+        self.depth = depth
+        if self.snapshot_path is None and depth % self.every == 0:
+            self.snapshots[depth] = dict(self.table)
+
+    def balance_at(self, account, depth):
+        # Raises KeyError for an unknown account and ValueError for a depth not applied yet
+        if account not in self.genesis:
+            raise KeyError(account)
+        if not 0 <= depth <= self.depth:
+            raise ValueError(f"Depth {depth} is outside 0..{self.depth}")
+        i = bisect.bisect_right(self.depths.get(account, []), depth)
+        return self.balances[account][i - 1] if i else self.genesis[account]
+
+    def table_at(self, depth):
+        return {account: self.balance_at(account, depth) for account in self.genesis}
+
+    def transfers(self, blockchain, depth, account):
+        # The transfers of block `depth` that moved the account's money. Which of the block's transfers
+        # were rejected follows from the balances before it.
+        def balance(other):
+            return self.balance_at(other, depth - 1) if other in self.genesis else None
+        transactions = transactions_of(blockchain[depth - 1].transaction)
+        _, rejected = net_effect(balance, transactions)
+        skipped = Counter(rejected)
+        transfers = []
+        for tx in transactions:
+            if skipped[tx]:
+                skipped[tx] -= 1
+            elif account in (tx[0], tx[1]):
+                transfers.append(tx)
+        return transfers
+
+    def account_history(self, account, blockchain, limit=None):
+        # The latest `limit` blocks touching the account, oldest first
+        if account not in self.genesis:
+            raise KeyError(account)
+        depths = self.depths.get(account, [])
+        start = 0 if limit is None else max(len(depths) - limit, 0)
+        return [{"depth": depths[i], "balance": self.balances[account][i], "transfers": self.transfers(blockchain, depths[i], account)}
+                for i in range(start, len(depths))]
+
+    def _snapshots(self):
+        yield from self.snapshots.items()
+        if self.snapshot_path is not None:
+            for depth, table in read_snapshots(self.snapshot_path):
+                if depth <= self.depth:
+                    yield depth, table
+
+    def audit(self, table):
+        # Depths at which the index disagrees with a snapshot or `table` with the latest balances
+        mismatches = [depth for depth, snapshot in self._snapshots() if self.table_at(depth) != snapshot]
+        if self.table_at(self.depth) != {account: table.get(account) for account in self.genesis}:
+            mismatches.append(self.depth)
+        return sorted(set(mismatches))
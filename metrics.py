@@ -0,0 +1,100 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import threading
+
+# Histogram bucket upper bounds in seconds: ten per decade from 10 us to 100 s, each 26% wider
+# than the one before
+BUCKETS = [10.0 ** (e / 10) for e in range(-50, 21)]
+
+class Histogram:
+    __slots__ = ("counts", "total", "n", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.n += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Interpolated within the bucket the q-th observation falls in
+        rank = q * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+                return low + (high - low) * max(rank - seen, 0) / count
+            seen += count
+        return 0.0
+
+class Metrics:
+    # Counters and latency histograms for one peer. Disabled, every call returns at once, so the
+    # instrumented code only pays for reading the clock.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(seconds)
+
+    def render(self, extra=None):
+        # One "name value" line per number; histogram lines carry their quantile in braces
+        lines = []
+        with self.lock:
+            counters = {**(extra or {}), **self.counters}
+            for name in sorted(counters):
+                lines.append(f"{name} {counters[name]}")
+            for name in sorted(self.histograms):
+                h = self.histograms[name]
+                lines.append(f"{name}_seconds_count {h.n}")
+                lines.append(f"{name}_seconds_sum {h.total:.6f}")
+                for q in (0.5, 0.9, 0.99):
+                    lines.append(f'{name}_seconds{{quantile="{q}"}} {h.quantile(q):.6f}')
+                lines.append(f"{name}_seconds_max {h.max:.6f}")
+        if not self.enabled:
+            lines.append("# histograms are disabled, start the peer with --metrics")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, extra=None, ip="127.0.0.1"):
+        # Plain text on GET /metrics; extra is called for counters kept elsewhere
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render(extra() if extra else None).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((ip, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
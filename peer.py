@@ -1,55 +1,195 @@
-from blockchain import Block, BlockChain
+from blockchain import Block, BlockChain, transactions_of, normalize_transaction, canonical_encoding, generate_hash, pointer_digest, NONCE_START_LIMIT
 from utils import *
+from wire import WIRE_VERSION
+from transport import TcpTransport, NETWORK_DELAY
+from aio import AsyncTransport
+from metrics import Metrics
+from history import BalanceHistory
+from config import ClusterConfig
+from admission import Admission, MAX_PENDING
+from collections import Counter, OrderedDict, deque
+import random
 import threading
-import queue
-import socket
 import time
-import json
+
+RECOVERY_CHUNK = 256
+# How long fixProcess waits for its recovery request to reach the other peers
+FIX_TIMEOUT = 2.0
+# Thrifty Prepares and Accepts go to the members that have answered fastest, just enough for a
+# quorum. The rest are asked once THRIFTY_SLACK times the slowest expected reply has passed, and
+# every THRIFTY_PROBE_EVERY-th message goes to everyone so that slow members are measured again.
+THRIFTY_SLACK = 3.0
+THRIFTY_MIN_TIMEOUT = 0.02
+THRIFTY_PROBE_EVERY = 32
+# Weight of the newest sample in each member's average reply time
+REPLY_EWMA = 0.2
+# A Prepare or Accept whose quorum has not answered within the estimated round trip is tried again
+# with a higher ballot, after a random backoff that doubles with every failed attempt so that
+# dueling proposers stop preempting each other. The wait for a quorum doubles only when it stayed
+# silent, not when another proposer preempted us.
+RETRY_INITIAL_TIMEOUT = 1.0
+RETRY_MIN_TIMEOUT = 0.05
+RETRY_MAX_TIMEOUT = 2.0
+BACKOFF_BASE = 0.01
+BACKOFF_MAX = 1.0
+# How many transfers a peer remembers the outcome of, so one sent again or proposed by two peers is not applied twice
+OUTCOME_MEMORY = 65536
+# Resends of a forwarded transfer before its origin gives up on the leader and proposes it itself
+FORWARD_RETRIES = 3
+# How many recent decided blocks keep their refs, so a peer catching up by recovery learns them too
+REF_BLOCKS = 4096
+# The balance history replays the blocks its file misses without self.lock until at most this many
+# are left, which it replays under the lock so that no block is applied in between
+HISTORY_CATCH_UP = 256
+
+class RoundTimer:
+    # Smoothed quorum round trip and its deviation, kept the way TCP keeps its retransmission timer
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def observe(self, sample):
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar += 0.25 * (abs(sample - self.srtt) - self.rttvar)
+            self.srtt += 0.125 * (sample - self.srtt)
+
+    def timeout(self, attempts=0):
+        base = RETRY_INITIAL_TIMEOUT if self.srtt is None else max(self.srtt + 4 * self.rttvar, RETRY_MIN_TIMEOUT)
+        return min(base * 2 ** attempts, RETRY_MAX_TIMEOUT)
+
+class Round:
+    def __init__(self, depth, block, batch, started, effect=None, refs=None):
+        self.depth = depth
+        self.block = block
+        self.batch = batch
+        # (origin, seq) of each transfer in the block, in order
+        self.refs = refs if refs is not None else [ref for _, _, ref in batch]
+        # Net change to each account touched once the block is applied on the rounds before it
+        self.effect = effect if effect is not None else {}
+        self.accepted_peers = set()
+        self.decision_sent = False
+        self.started = started
+        self.accept_sent = started
+        self.accept_msg = None
+        self.asked = set()
+        self.escalate_at = None
+        self.escalated = None
+        self.deadline = None
 
 class Peer:
-    def __init__(self, id, debug=0, load=False):
+    def __init__(self, id, debug=0, load=False, batch_size=32, batch_linger=0.05, round_timeout=30, stable_leader=True, window=4, pow_workers=1, wire="binary", runtime="threads", network_delay=NETWORK_DELAY, transport=None, persist=True, metrics=False, config=None, thrifty=False, max_pending=MAX_PENDING):
 
         self.id = id
         self.debug = debug
-        self.ip = "127.0.0.1"
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.round_timeout = round_timeout
+        self.stable_leader = stable_leader
+        self.window = window if stable_leader else 1
+        self.thrifty = thrifty
+        self.pow_workers = pow_workers
+        self.wire = wire
         self.dead = False
-
-        if load:
-            at, pb, bc = load_file(f"./data/c_{self.id}.json")
+        self.config = config if config is not None else ClusterConfig.local()
+
+        if transport is None:
+            transport = AsyncTransport(network_delay) if runtime == "asyncio" else TcpTransport(network_delay)
+        self.transport = transport
+        self.clock = transport.clock
+        self.metrics = Metrics(metrics)
+
+        # Without persist nothing is written to disk, e.g. for simulated clusters
+        filepath = f"./data/c_{self.id}.json" if persist else None
+        self.state_log = StateLog(filepath, metrics=self.metrics)
+        # The balances every account starts with; the history replays the chain from these
+        self.genesis = self.config.genesis()
+        bc = None
+        if load and persist:
+            at, pb, bc = load_file(filepath, pow_workers)
+        if bc is not None:
             self.account_table = {int(k): v for k, v in at.items()} if isinstance(at, dict) else at
             self.promised_ballot = tuple(pb) if pb is not None else (0,0)
             self.blockchain = bc
+            self.state_log.tail_hash = bc.tail.hash_value if bc.tail else None
+            self.state_log.open_history(bc.len)
         else:
+            # Nothing usable on disk; the peer starts empty and catches up through recovery
             self.blockchain = BlockChain()
-            self.account_table = {i: 100 for i in range(1,6)}
+            self.account_table = dict(self.genesis)
             self.promised_ballot = (0,0)    
 
-            filepath = f"./data/c_{self.id}.json"
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, "w") as f:
-                json.dump({"variables": {}, "blockchain": []}, f, indent=2)
-            if self.debug:
+            if not self.state_log.reset(self.account_table, self.promised_ballot, self.blockchain):
+                print(f"Could not write state file {filepath}: {self.state_log.error}")
+            elif self.debug:
                 print(f"[DEBUG C-{self.id}] Reset state file {filepath} to empty")
 
-        self.request_queue = queue.Queue()
+        # Read back from the state log the first time a balance query needs it, so loading stays quick
+        self.history = None
+        self.history_lock = threading.Lock()
         self.lock = threading.Lock()
 
-        threading.Thread(target=self._listener_thread, daemon=True).start()
-        for _ in range(4):
-            threading.Thread(target=self._worker_thread, daemon=True).start()
+        self.stats_lock = threading.Lock()
+        self.stats = {"reconnects": 0, "frames_sent": 0, "frames_received": 0, "frames_dropped": 0, "thrifty_escalations": 0, "round_retries": 0, "forward_retries": 0, "forward_fallbacks": 0}
+        # Binary wire versions each peer said it accepts; JSON is always understood
+        self.peer_wire = {}
 
         self.ballot_Num = 0
-        self.current_depth = 0          
-        self.proposed_ballot = (0,0)
-
+        self.ballot = None
+        self.is_leader = False
+        self.leader_id = None
+        self.preparing = False
+        self.prepare_started = 0
+        self.prepare_depth = 0
         self.promised_peers = set()
-        self.accepted_peers = set()
-
-        self.highest_accepted_num = None
-        self.highest_accepted_val = None
-        self.decision_sent = False
-
-        self.recovery_event = threading.Event()
+        self.promised_values = {}
+        self.prepare_msg = None
+        self.prepare_asked = set()
+        self.prepare_escalate_at = None
+        self.prepare_escalated = None
+        self.prepare_deadline = None
+        self.rounds = {}
+        # Stalled rounds are prepared again at retry_at. Since our last commit, attempts counts the
+        # ballots we gave up and stalls those given up because the quorum stayed silent.
+        self.timer = RoundTimer()
+        self.attempts = 0
+        self.stalls = 0
+        self.retry_at = None
+        self.rng = random.Random()
+        # Average Promise/Accepted round trip per member, which thrifty mode ranks them by
+        self.reply_time = {}
+        self.quorum_messages = 0
+
+        self.accepted = {}
+        self.decided = {}
+        self.apply_lock = threading.Lock()
+        self.gap_since = None
+        self.recovering_since = None
+        self.recovery_session = 0
+        self.full_recovery = None
+
+        self.pending = deque()
+        self.pending_cv = threading.Condition(self.lock)
+        self.admission = Admission(max_pending)
+        self.forward_seq = 0
+        # Our transfers waiting on a leader: seq -> (first sent, leader, entry, last sent, attempts)
+        self.forwarded = {}
+        self.forward_timer = RoundTimer()
+        # Checking every forward is linear in how many are waiting, so it is done a few times per resend
+        # timeout rather than on every wakeup of the proposer
+        self.forward_check_at = 0.0
+        # Transfers forwarded to us or seen decided: (origin, seq) -> "committed", "rejected" or None while in flight
+        self.outcomes = OrderedDict()
+        # depth -> refs of the last REF_BLOCKS decided blocks, passed on in recovery chunks
+        self.block_refs = OrderedDict()
+        # Called with the sequence number moneyTransfer returned once that transfer is committed
+        self.on_commit = None
+        # Called with that sequence number and "committed", "rejected" (the paying account could not
+        # cover it) or "unknown" (given up on; it may still be committed by a later leader)
+        self.on_outcome = None
+        self.transport.start(self)
+        threading.Thread(target=self._proposer_thread, daemon=True).start()
 
     def print_blockchain(self):
         with self.lock:
@@ -58,90 +198,188 @@ class Peer:
     def print_table(self):
         with self.lock:
             print(self.account_table)
+
+    def balance_history(self):
+        # Caller must not hold self.lock. The index is read back from the history file, and the blocks
+        # it misses (all of them without a state file, or after a full recovery) are replayed. Blocks
+        # below the chain length never change, so both happen without the lock; the history is read
+        # under it, as every new block is recorded then.
+        with self.history_lock:
+            while True:
+                with self.lock:
+                    if self.history is not None:
+                        return self.history
+                    chain, depth = self.blockchain, self.blockchain.len
+                if self.state_log.path:
+                    history = BalanceHistory.load(self.state_log.path, self.genesis, depth)
+                else:
+                    history = BalanceHistory(self.genesis)
+                replayed = []
+                while True:
+                    replayed += history.extend(chain, depth)
+                    with self.lock:
+                        if self.blockchain is not chain:
+                            # Replaced by a full recovery; start over on the new chain
+                            break
+                        depth = chain.len
+                        if depth - history.depth <= HISTORY_CATCH_UP:
+                            replayed += history.extend(chain, depth)
+                            self.history = history
+                            # Queued behind every block applied so far, so the file stays in depth order
+                            self.state_log.append_history(replayed)
+                            return history
+
+    def print_balance_at(self, account, depth):
+        account, depth = int(account), int(depth)
+        history = self.balance_history()
+        with self.lock:
+            try:
+                print(f"Balance of account {account} at depth {depth}: {history.balance_at(account, depth)}")
+            except KeyError:
+                print("Invalid account ID")
+            except ValueError:
+                print(f"Depth must be between 0 and {history.depth}")
+
+    def print_history(self, account, limit=10):
+        account, limit = int(account), int(limit)
+        history = self.balance_history()
+        with self.lock:
+            try:
+                entries = history.account_history(account, self.blockchain, limit)
+            except KeyError:
+                print("Invalid account ID")
+                return
+        for entry in entries:
+            transfers = ", ".join(f"{a}->{b} {amount}" for a, b, amount in entry["transfers"])
+            print(f"Depth {entry['depth']}: {transfers}, balance {entry['balance']}")
+        if not entries:
+            print(f"No transfers for account {account}")
+
+    def print_audit(self):
+        history = self.balance_history()
+        with self.lock:
+            mismatches = history.audit(self.account_table)
+            depth = history.depth
+        if mismatches:
+            print(f"Balances disagree with the chain at depths {mismatches}")
+        else:
+            print(f"Balances match the chain up to depth {depth}")
     
     def fix(self):
         if self.debug:
             print(f"[DEBUG C-{self.id}] Fixing process.")
-        msg = {"type": "Recovery", "from": self.id}
-        for i in range(1,6):
-            if i != self.id:
-                self.send(i, msg)
+        msg = self.recovery_request()
+        reached = self.broadcast(msg, timeout=FIX_TIMEOUT)
+        if self.debug and reached is not None:
+            print(f"[DEBUG C-{self.id}] Recovery request reached {sorted(reached)}")
         self.dead = False
     
-    def send(self, target_id, msg):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s_socket:
-                s_socket.connect((self.ip, target_id * 1234))
-                if self.debug == 1:
-                    print(f"[DEBUG C-{self.id}] Sending to C-{target_id}: {msg}")
-                elif self.debug == 2:
-                    print(f"[DEBUG C-{self.id}] Sending to C-{target_id}, Type: {msg["type"]}")
-                data = json.dumps(msg).encode()
-                length = len(data).to_bytes(4, "big")
-                s_socket.sendall(length + data)
-        except Exception as e:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Could not send message to C-{target_id}, Error: {e}")
-
-    def send_prepare(self):
-        promised = getattr(self, "promised_ballot", (0,0))
-        self.ballot_Num = max(self.ballot_Num, promised[0]) + 1
-        self.ballot = (self.ballot_Num, self.id)
+    def print_stats(self):
+        print(self.counters())
 
-        self.current_depth = self.blockchain.len + 1
+    def counters(self):
+        with self.stats_lock:
+            return {**self.stats, **self.state_log.stats}
 
-        with self.lock:
-            self.promised_peers = set()
-            self.accepted_peers = set()
-            self.decision_sent = False
-            self.highest_accepted_num = None
-            self.highest_accepted_val = None
+    def print_metrics(self):
+        print(self.metrics.render(self.counters()), end="")
 
-            if not hasattr(self, "proposed_block") or self.proposed_block is None:
-                if self.debug:
-                    print(f"[DEBUG C-{self.id}] Warning: sending Prepare with no proposed_block")
+    def count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
 
-        msg = {
-            "type": "Prepare",
-            "ballot": self.ballot,
-            "from": self.id,
-            "depth": self.current_depth
-        }
+    def send(self, target_id, msg, compress=False):
+        if self.debug == 1:
+            print(f"[DEBUG C-{self.id}] Sending to C-{target_id}: {msg}")
+        elif self.debug == 2:
+            print(f"[DEBUG C-{self.id}] Sending to C-{target_id}, Type: {msg["type"]}")
+        frame = encode_frame(msg, compress, self.wire == "binary" and WIRE_VERSION in self.peer_wire.get(target_id, ()))
+        if msg["type"] == "Recovery Chunk":
+            self.metrics.count("recovery_bytes_sent", len(frame))
+        self.transport.send(target_id, frame)
+
+    def broadcast(self, msg, targets=None, timeout=None):
+        # Sends msg to every other member at once, encoded once per wire format. Returns at once
+        # unless a timeout is given; then it waits that long and returns the members it reached.
+        targets = self.config.others(self.id) if targets is None else targets
+        if self.debug == 1:
+            print(f"[DEBUG C-{self.id}] Broadcasting to {['C-' + str(i) for i in targets]}: {msg}")
+        elif self.debug == 2:
+            print(f"[DEBUG C-{self.id}] Broadcasting to {len(targets)} peers, Type: {msg["type"]}")
+        frames = {}
+        encoded = {}
+        for target_id in targets:
+            binary = self.wire == "binary" and WIRE_VERSION in self.peer_wire.get(target_id, ())
+            if binary not in encoded:
+                encoded[binary] = encode_frame(msg, binary=binary)
+            frames[target_id] = encoded[binary]
+        return self.transport.broadcast(frames, timeout)
+
+    def hello_frame(self):
+        # Every connection opens by telling the other side which formats we can read
+        return encode_frame({"type": "Hello", "from": self.id, "wire": [WIRE_VERSION] if self.wire == "binary" else []})
 
-        for i in range(1, 6):
-            if i != self.id:
-                self.send(i, msg)
+    def send_prepare(self):
+        with self.lock:
+            self.ballot_Num = max(self.ballot_Num, self.promised_ballot[0]) + 1
+            self.ballot = (self.ballot_Num, self.id)
+            self.is_leader = False
+            self.preparing = True
+            self.prepare_started = self.clock()
+            self.prepare_depth = self.blockchain.len + 1
+            self.promised_peers = set()
+            # The proposer is a member of its own quorum, so it promises its ballot and
+            # counts what it has accepted itself like any other Promise
+            self.promised_ballot = self.ballot
+            self.promised_values = {d: (b, {**dict_from_block(block), "refs": refs}) for d, (b, block, refs) in self.accepted.items() if d >= self.prepare_depth}
+
+            msg = {
+                "type": "Prepare",
+                "ballot": self.ballot,
+                "from": self.id,
+                "depth": self.prepare_depth
+            }
+            self.prepare_msg = msg
+            targets, self.prepare_escalate_at = self._quorum_targets()
+            self.prepare_asked = set(targets)
+            self.prepare_escalated = None
+            self.prepare_deadline = (self.prepare_escalate_at or self.prepare_started) + self.timer.timeout(self.stalls)
+
+        self.broadcast(msg, targets)
 
     def handle_prepare(self, req):
         ballot = tuple(req["ballot"])
         proposer_id = req["from"]
         depth = req["depth"]
 
-        local_depth = self.blockchain.len
-        if depth < local_depth + 1:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Prepare' from C-{proposer_id} with depth {depth} <= local depth {local_depth}")
-            return
+        with self.lock:
+            local_depth = self.blockchain.len
+            promised = self.promised_ballot
+            if depth < local_depth + 1 or ballot < promised:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ignoring 'Prepare' from C-{proposer_id} with ballot {ballot}, depth {depth} (promised {promised}, local depth {local_depth})")
+                nack = True
+            else:
+                nack = False
+                self.promised_ballot = ballot
+                if self.is_leader and ballot > self.ballot:
+                    if self.debug:
+                        print(f"[DEBUG C-{self.id}] Stepping down as leader for ballot {ballot}")
+                    self.is_leader = False
 
-        promised = getattr(self, "promised_ballot", (0,0))
-        if ballot < promised:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Prepare' from C-{proposer_id} with ballot {ballot} < promised {promised}")
-            return
+                # One Prepare covers every depth from `depth` on, so report all of them
+                accepted = [[d, list(b), {**dict_from_block(block), "refs": refs}] for d, (b, block, refs) in sorted(self.accepted.items()) if d >= depth]
 
-        with self.lock:
-            self.promised_ballot = ballot
+        if nack:
+            self.send_nack(proposer_id, ballot, promised)
+            return
 
         reply_msg = {
             "type": "Promise",
             "ballot": ballot,
             "from": self.id,
             "depth": depth,
-            "accepted_ballot": self.highest_accepted_num,
-            "accepted_tx": self.highest_accepted_val.transaction if self.highest_accepted_val else None,
-            "accepted_nonce": self.highest_accepted_val.nonce if self.highest_accepted_val else None,
-            "accepted_hash": self.highest_accepted_val.hash_value if self.highest_accepted_val else None,
-            "accepted_hash_pointer": self.highest_accepted_val.hash_pointer if self.highest_accepted_val else None
+            "accepted": accepted
         }
 
         self.send(proposer_id, reply_msg)
@@ -150,222 +388,535 @@ class Peer:
         promised_id = req["from"]
         ballot = tuple(req["ballot"])
 
-        if ballot != getattr(self, "ballot", None):
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Promise' from C-{promised_id} with ballot {ballot} != current ballot {getattr(self, 'ballot', None)}")
-            return
+        with self.lock:
+            if ballot != self.ballot or not self.preparing or req["depth"] != self.prepare_depth:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ignoring 'Promise' from C-{promised_id} with ballot {ballot} != current ballot {self.ballot}")
+                return
 
-        accepted_ballot_raw = req.get("accepted_ballot", None)
-        accepted_tx = req.get("accepted_tx", None)
-        accepted_nonce = req.get("accepted_nonce", None)
-        accepted_hash = req.get("accepted_hash", None)
-        accepted_hash_pointer = req.get("accepted_hash_pointer", None)
+            self.promised_peers.add(promised_id)
+            self._record_reply(promised_id, self.prepare_asked, self.prepare_started, self.prepare_escalated)
+            for depth, accepted_ballot, block in req.get("accepted", []):
+                accepted_ballot = tuple(accepted_ballot)
+                if depth not in self.promised_values or accepted_ballot > self.promised_values[depth][0]:
+                    if self.debug:
+                        print(f"[DEBUG C-{self.id}] C-{promised_id} reports value accepted at depth {depth} with ballot {accepted_ballot}")
+                    self.promised_values[depth] = (accepted_ballot, block)
 
-        accepted_ballot = None
-        if accepted_ballot_raw is not None:
-            if isinstance(accepted_ballot_raw, list):
-                accepted_ballot = tuple(accepted_ballot_raw)
-            else:
-                accepted_ballot = accepted_ballot_raw
+            # The proposer's own promise makes up the rest of the quorum
+            if len(self.promised_peers) + 1 < self.config.quorum:
+                return
 
-        with self.lock:
-            self.promised_peers.add(promised_id)
+            self.metrics.observe("prepare_quorum", self.clock() - self.prepare_started)
+            self.timer.observe(self.clock() - self.prepare_started)
+            self.preparing = False
+            self.is_leader = True
+            self.leader_id = self.id
+            lost = self._adopt_promised_values()
+            rounds = [self.rounds[d] for d in sorted(self.rounds)]
+
+        self._requeue(lost)
+        for r in rounds:
+            self.send_accept(r)
+
+    def _adopt_promised_values(self):
+        # Caller holds self.lock. Values reported by the Promise quorum take precedence over
+        # our own in-flight blocks; own blocks that no longer chain onto them are given up, as are
+        # those holding a transfer already in an adopted block or decided elsewhere.
+        prev = self.blockchain.get_tail()
+        depth = self.blockchain.len + 1
+        old_rounds = self.rounds
+        self.rounds = {}
+        lost = []
+        adopted = set()
 
-            if accepted_ballot is not None and accepted_tx is not None:
-                if (self.highest_accepted_num is None) or (accepted_ballot > self.highest_accepted_num):
-                    if self.debug:
-                        print(f"[DEBUG C-{self.id}] Adopting previous value reported by C-{promised_id} with accepted_ballot={accepted_ballot}")
-                    try:
-                        adopted = Block.reconstruct(
-                            tx=accepted_tx,
-                            nonce=accepted_nonce,
-                            hash_value=accepted_hash,
-                            prev=self.blockchain.get_tail(),  
-                            hash_pointer=accepted_hash_pointer
-                        )
-                        self.highest_accepted_num = accepted_ballot
-                        self.highest_accepted_val = adopted
-                    except Exception as e:
-                        if self.debug:
-                            print(f"[DEBUG C-{self.id}] Failed to reconstruct accepted block from C-{promised_id}: {e}")
-
-
-            if len(self.promised_peers) == 2:
-                if self.highest_accepted_val is not None:
-                    self.proposed_block = self.highest_accepted_val
-                send_accept_needed = True
+        while True:
+            if depth in self.promised_values:
+                info = self.promised_values[depth][1]
+                block = Block.reconstruct(tx=info["transaction"], nonce=info["nonce"], hash_value=info["hash_value"], prev=prev, hash_pointer=info["hash_pointer"])
+                refs = list(map(tuple, info.get("refs", ())))
+            elif depth in old_rounds:
+                block = old_rounds[depth].block
+                refs = old_rounds[depth].refs
+                if any(ref in adopted or self.outcomes.get(ref) is not None for ref in refs):
+                    break
             else:
-                send_accept_needed = False
-
-        if send_accept_needed:
-            self.send_accept()
+                break
+            if not block.verify(prev):
+                break
 
-    def send_accept(self):
+            own = old_rounds.pop(depth, None)
+            if own is not None and own.block.hash_value == block.hash_value and own.block.nonce == block.nonce:
+                self.rounds[depth] = own
+            else:
+                if own is not None:
+                    lost.extend(own.batch)
+                effect, _ = net_effect(self._projection(), transactions_of(block.transaction))
+                self.rounds[depth] = Round(depth, block, [], self.clock(), effect, refs)
+            adopted.update(refs)
+            prev = block
+            depth += 1
+
+        for d in sorted(old_rounds):
+            lost.extend(old_rounds[d].batch)
+        return [entry for entry in lost if entry[2] not in adopted]
+
+    def send_accept(self, r):
         with self.lock:
-            block = self.proposed_block
             ballot = self.ballot
-            depth = self.current_depth
-
-        if block is None:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] send_accept called but no proposed_block set for ballot {ballot}")
-            return
-
-        msg = {
-            "type": "Accept",
-            "ballot": ballot,
-            "from": self.id,
-            "depth": depth,
-            "tx": block.transaction,
-            "nonce": block.nonce,
-            "hash_value": block.hash_value,
-            "hash_pointer": block.hash_pointer
-        }
-        for i in range(1, 6):
-            if i != self.id:
-                self.send(i, msg)
+            if ballot is None or self.promised_ballot > ballot:
+                # Promised a higher ballot since; the round waits for that leader's decision,
+                # and is prepared again if none comes
+                r.deadline = self.clock() + self.timer.timeout(self.stalls)
+                return
+            r.accepted_peers = set()
+            r.accept_sent = self.clock()
+            # Our own acceptance is one vote of the quorum, so a later leader must hear of it
+            self.accepted[r.depth] = (ballot, r.block, r.refs)
+
+            msg = {
+                "type": "Accept",
+                "ballot": ballot,
+                "from": self.id,
+                "depth": r.depth,
+                "tx": r.block.transaction,
+                "nonce": r.block.nonce,
+                "hash_value": r.block.hash_value,
+                "hash_pointer": r.block.hash_pointer,
+                "refs": r.refs
+            }
+            r.accept_msg = msg
+            targets, r.escalate_at = self._quorum_targets()
+            r.asked = set(targets)
+            r.escalated = None
+            r.deadline = (r.escalate_at or r.accept_sent) + self.timer.timeout(self.stalls)
+        self.broadcast(msg, targets)
+
+    def _quorum_targets(self):
+        # Caller holds self.lock. Returns the members to send a Prepare or Accept to, and when to
+        # ask the others if the quorum is still short, or None when every member is asked.
+        others = self.config.others(self.id)
+        needed = self.config.quorum - 1
+        self.quorum_messages += 1
+        if not self.thrifty or needed >= len(others) or self.quorum_messages % THRIFTY_PROBE_EVERY == 0:
+            return others, None
+        asked = sorted(others, key=lambda i: (self.reply_time.get(i, 0.0), i))[:needed]
+        expected = max(self.reply_time.get(i, 0.0) for i in asked)
+        return asked, self.clock() + max(THRIFTY_MIN_TIMEOUT, THRIFTY_SLACK * expected)
+
+    def _record_reply(self, peer_id, asked, sent, escalated):
+        # Caller holds self.lock. Members asked only when the message was escalated count from then.
+        rtt = self.clock() - (sent if peer_id in asked or escalated is None else escalated)
+        average = self.reply_time.get(peer_id)
+        self.reply_time[peer_id] = rtt if average is None else average + REPLY_EWMA * (rtt - average)
+
+    def _escalations(self, now):
+        # Caller holds self.lock. Prepares and Accepts whose quorum is overdue, with the members
+        # that have not been asked yet; those that were asked and stayed silent rank lower from now on.
+        escalate = []
+        quorum = self.config.quorum
+        if self.preparing and self.prepare_escalate_at is not None and now >= self.prepare_escalate_at:
+            if len(self.promised_peers) + 1 < quorum:
+                for i in self.prepare_asked - self.promised_peers:
+                    self.reply_time[i] = max(self.reply_time.get(i, 0.0), now - self.prepare_started)
+                escalate.append((self.prepare_msg, [i for i in self.config.others(self.id) if i not in self.prepare_asked]))
+                self.prepare_escalated = now
+            self.prepare_escalate_at = None
+        for r in self.rounds.values():
+            if r.escalate_at is None or now < r.escalate_at:
+                continue
+            if len(r.accepted_peers) + 1 < quorum and r.accept_msg is not None:
+                for i in r.asked - r.accepted_peers:
+                    self.reply_time[i] = max(self.reply_time.get(i, 0.0), now - r.accept_sent)
+                escalate.append((r.accept_msg, [i for i in self.config.others(self.id) if i not in r.asked]))
+                r.escalated = now
+            r.escalate_at = None
+        return escalate
+
+    def _next_deadline(self, now):
+        # Caller holds self.lock. Seconds until the earliest escalation, retry or quorum deadline, at most 1
+        quorum = self.config.quorum
+        deadlines = [r.escalate_at for r in self.rounds.values() if r.escalate_at is not None]
+        if self.preparing and self.prepare_escalate_at is not None:
+            deadlines.append(self.prepare_escalate_at)
+        if self.retry_at is not None:
+            deadlines.append(self.retry_at)
+        elif self.preparing:
+            deadlines.append(self.prepare_deadline)
+        else:
+            deadlines.extend(r.deadline for r in self.rounds.values() if r.deadline is not None and not r.decision_sent and len(r.accepted_peers) + 1 < quorum)
+        if self.forwarded:
+            deadlines.append(self.forward_check_at)
+        return min([1.0, *(max(d - now, 0.001) for d in deadlines)])
+
+    def _stalled(self, now):
+        # Caller holds self.lock. When a quorum has not answered our ballot in time, gives it up and
+        # schedules a Prepare with a higher one; returns the backoff, or None if nothing stalled
+        if self.retry_at is not None or not self.rounds:
+            return None
+        quorum = self.config.quorum
+        if self.preparing:
+            if now < self.prepare_deadline or len(self.promised_peers) + 1 >= quorum:
+                return None
+        elif not any(r.deadline is not None and now >= r.deadline and not r.decision_sent and len(r.accepted_peers) + 1 < quorum for r in self.rounds.values()):
+            return None
+        self.attempts += 1
+        self.stalls += 1
+        self.preparing = False
+        self.is_leader = False
+        for r in self.rounds.values():
+            r.deadline = None
+        return self._back_off(now)
+
+    def _back_off(self, now):
+        # Caller holds self.lock. No new Prepare goes out before retry_at
+        backoff = self.rng.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.attempts))
+        self.retry_at = now + backoff
+        return backoff
 
     def handle_accept(self, req):
         ballot = tuple(req["ballot"])
         proposer_id = req["from"]
         depth = req["depth"]
 
-        if depth < self.blockchain.len + 1:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Accept' from C-{proposer_id} with depth {depth} <= local depth {self.blockchain.len}")
+        with self.lock:
+            local_depth = self.blockchain.len
+            promised = self.promised_ballot
+            if depth < local_depth + 1 or ballot < promised:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ignoring 'Accept' from C-{proposer_id} with ballot {ballot}, depth {depth} (promised {promised}, local depth {local_depth})")
+                nack = True
+            else:
+                nack = False
+                if depth == local_depth + 1:
+                    prev = self.blockchain.get_tail()
+                else:
+                    prev = self.accepted[depth - 1][1] if depth - 1 in self.accepted else None
+
+                new_block = Block.reconstruct(
+                    tx=req["tx"],
+                    nonce=req["nonce"],
+                    hash_value=req["hash_value"],
+                    prev=prev,
+                    hash_pointer=req["hash_pointer"]
+                )
+
+                # Without the previous block at hand only the block's own hash can be checked here;
+                # the pointer is checked again when the decision is applied in order
+                valid = new_block.verify(prev) if (prev is not None or depth == 1) else new_block.verify_hash()
+                if valid:
+                    self.promised_ballot = ballot
+                    self.accepted[depth] = (ballot, new_block, list(map(tuple, req.get("refs", ()))))
+                    self.leader_id = proposer_id
+                    if self.is_leader and ballot > self.ballot:
+                        self.is_leader = False
+            behind = depth > local_depth + 2 * self.window
+
+        if nack:
+            self.send_nack(proposer_id, ballot, promised)
             return
-        elif depth > self.blockchain.len + 1:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Appears to be behind C-{proposer_id}")
-            print("Recovering")
-            msg = {"type": "Recovery", "from": self.id}
-            self.recovery_event.clear()
-            self.send(proposer_id, msg)
-            self.recovery_event.wait()
-
-        promised = getattr(self, "promised_ballot", (0,0))
-        if ballot < promised:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Accept' from C-{proposer_id} with ballot {ballot} < promised {promised}")
-            return
-        
-        new_block = Block.reconstruct(
-            tx=req["tx"],
-            nonce=req["nonce"],
-            hash_value=req["hash_value"],
-            prev=req["hash_pointer"],
-            hash_pointer=req["hash_pointer"]
-        )
-        
-        if not new_block.verify(self.blockchain.get_tail()):
+        if not valid:
             if self.debug:
                 print(f"[DEBUG C-{self.id}] Rejecting 'Accept' from C-{proposer_id}: Block verification failed")
             return
 
-        with self.lock:
-            self.promised_ballot = ballot
-            self.highest_accepted_num = ballot
-            self.highest_accepted_val = new_block
-
         reply_msg = {
             "type": "Accepted",
             "ballot": ballot,
             "from": self.id,
+            "depth": depth
         }
 
         self.send(proposer_id, reply_msg)
 
+        if behind:
+            if self.debug:
+                print(f"[DEBUG C-{self.id}] Appears to be behind C-{proposer_id}")
+            self.request_recovery(proposer_id)
+
     def handle_accepted(self, req):
         accepted_id = req["from"]
         ballot = tuple(req["ballot"])
-
-        if ballot != getattr(self, "ballot", None):
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Accepted' from C-{accepted_id} with ballot {ballot} != current ballot {getattr(self, 'ballot', None)}")
-            return
+        depth = req["depth"]
 
         with self.lock:
-            self.accepted_peers.add(accepted_id)
-
-        if len(self.accepted_peers) == 2 and not self.decision_sent:
-            self.send_decision()
-        elif self.debug:
-            if len(self.accepted_peers) < 2:
-                print(f"[DEBUG C-{self.id}] Not enough peers have accepted yet. Count: {len(self.accepted_peers)}")
-            else:
-                print(f"[DEBUG C-{self.id}] Majority reached")
+            r = self.rounds.get(depth)
+            if ballot != self.ballot or r is None:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ignoring 'Accepted' from C-{accepted_id} with ballot {ballot} != current ballot {self.ballot} at depth {depth}")
+                return
 
-    def send_decision(self):
-        with self.lock:
-            if self.decision_sent:
+            r.accepted_peers.add(accepted_id)
+            self._record_reply(accepted_id, r.asked, r.accept_sent, r.escalated)
+            count = len(r.accepted_peers)
+            if count + 1 == self.config.quorum:
+                self.metrics.observe("accept_quorum", self.clock() - r.accept_sent)
+                self.timer.observe(self.clock() - r.accept_sent)
+            if count + 1 < self.config.quorum or r.decision_sent:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Depth {depth}: {count} peers have accepted")
                 return
-            self.decision_sent = True
+            ready = self._ready_decisions()
+
+        for r in ready:
+            self.send_decision(r)
+
+    def _ready_decisions(self):
+        # Caller holds self.lock. A block only becomes a decision once the block it points to has
+        # been decided: a quorum may accept depth d + 1 while our block at d still loses to another
+        # leader's, and a decision that does not chain onto the chain would strand every peer at d.
+        ready = []
+        prev = self.blockchain.get_tail()
+        depth = self.blockchain.len + 1
+        while depth in self.rounds:
+            r = self.rounds[depth]
+            if not r.decision_sent:
+                if len(r.accepted_peers) + 1 < self.config.quorum or r.block.hash_pointer != pointer_digest(prev):
+                    break
+                r.decision_sent = True
+                ready.append(r)
+            prev = r.block
+            depth += 1
+        return ready
+
+    def send_nack(self, target_id, ballot, promised):
+        msg = {
+            "type": "Nack",
+            "ballot": ballot,
+            "from": self.id,
+            "promised": promised,
+            "depth": self.blockchain.len
+        }
+        self.send(target_id, msg)
 
-        block = self.proposed_block
+    def handle_nack(self, req):
+        ballot = tuple(req["ballot"])
+        promised = tuple(req["promised"])
+
+        with self.lock:
+            behind = req.get("depth", 0) > self.blockchain.len
+            lost = []
+            if ballot == self.ballot and promised > ballot:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ballot {ballot} superseded by {promised}, stepping down")
+                if self.preparing:
+                    # No Accept went out for these blocks yet, so they can safely be proposed again,
+                    # though not before a backoff in case the other proposer is preparing too
+                    for d in sorted(self.rounds):
+                        lost.extend(self.rounds[d].batch)
+                    self.rounds = {}
+                    self.attempts += 1
+                    self._back_off(self.clock())
+                self.is_leader = False
+                self.preparing = False
+                self.ballot_Num = max(self.ballot_Num, promised[0])
+                self.leader_id = promised[1]
+                self.pending_cv.notify()
+
+        self._requeue(lost)
+        if behind:
+            self.request_recovery(req["from"])
+
+    def send_decision(self, r):
+        block = r.block
 
         msg = {
             "type": "Decision",
             "from": self.id,
-            "depth": self.current_depth,
+            "depth": r.depth,
             "tx": block.transaction,
             "nonce": block.nonce,
             "hash_value": block.hash_value,
-            "hash_pointer": block.hash_pointer
+            "hash_pointer": block.hash_pointer,
+            "refs": r.refs
         }
-        for i in range(1,6):
-            if i != self.id:
-                self.send(i, msg)
+        self.broadcast(msg)
 
-        self.implement_decision(block)
-        self.promised_peers = set()
-        self.accepted_peers = set()
-        self.proposed_block = None
+        self.deliver_decision(r.depth, block, refs=r.refs)
 
     def handle_decision(self, req):
         decider_id = req["from"]
-        depth = req.get("depth", self.blockchain.len + 1)
-
-        if depth < self.blockchain.len + 1:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Ignoring 'Decision' with depth {depth} < local depth {self.blockchain.len + 1}")
-            return
-        elif depth > self.blockchain.len + 1:
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Appears to be behind C-{decider_id}")
-            print("Recovering")
-            msg = {"type": "Recovery", "from": self.id}
-            self.recovery_event.clear()
-            self.send(decider_id, msg)
-            self.recovery_event.wait()
 
         new_block = Block.reconstruct(tx = req["tx"],
                                       nonce=req["nonce"],
                                       hash_value=req["hash_value"],
-                                      prev=req["hash_pointer"],
+                                      prev=None,
                                       hash_pointer=req["hash_pointer"])
-        
-        if not new_block.verify(self.blockchain.get_tail()):
-            if self.debug:
-                print(f"[DEBUG C-{self.id}] Rejecting 'Decision' from C-{decider_id}: Block verification failed")
-            return
 
-        self.implement_decision(new_block)
+        self.deliver_decision(req["depth"], new_block, decider_id, list(map(tuple, req.get("refs", ()))))
 
-    def implement_decision(self, new_block):
-        transaction = new_block.transaction
+    def deliver_decision(self, depth, block, source=None, refs=()):
         with self.lock:
-            self.blockchain.append(new_block)
-            self.account_table[int(transaction[0])] -= int(transaction[2])
-            self.account_table[int(transaction[1])] += int(transaction[2])
+            if depth <= self.blockchain.len:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Ignoring 'Decision' with depth {depth} <= local depth {self.blockchain.len}")
+                return
+            self.decided[depth] = (block, refs)
+            if source is not None and not self.is_leader:
+                # Members a thrifty leader left out of its Accepts learn who leads from its Decisions
+                self.leader_id = source
+            behind = depth > self.blockchain.len + 2 * self.window
 
-        self.ballot = None
-        self.highest_accepted_num = None
-        self.highest_accepted_val = None         
+        # Applying may wait for apply_lock and the state log, which an event loop must not do
+        self.transport.run_blocking(self._apply_decided)
 
-        handle_file(f"./data/c_{self.id}.json", {"account_table": self.account_table, "promised_ballot": self.promised_ballot}, new_block)
-        print("Done.")
+        if behind and source is not None:
+            if self.debug:
+                print(f"[DEBUG C-{self.id}] Appears to be behind C-{source}")
+            self.request_recovery(source)
+
+    def _apply_decided(self):
+        # Decisions can arrive out of order; apply them strictly by depth
+        commits = []
+        recover_from = None
+        with self.apply_lock:
+            while True:
+                with self.lock:
+                    depth = self.blockchain.len + 1
+                    block, refs = self.decided.pop(depth, (None, ()))
+                    if block is None:
+                        if not self.decided:
+                            self.gap_since = None
+                        elif self.gap_since is None:
+                            self.gap_since = self.clock()
+                        break
+                    tail = self.blockchain.get_tail()
+                    valid = block.verify(tail)
+                    if valid:
+                        block.prev = tail
+                if not valid:
+                    if self.debug:
+                        print(f"[DEBUG C-{self.id}] Discarding decision at depth {depth}: Block verification failed")
+                    if self.leader_id not in (None, self.id):
+                        recover_from = self.leader_id
+                    continue
+                commits.append(self.implement_decision(block, refs))
+
+        # Nothing is sent while apply_lock is held, so a send never waits on a handler that wants it
+        if recover_from is not None:
+            self.request_recovery(recover_from)
+        self._finish_commits(commits)
+
+        # Rounds that reached a quorum out of order are decided once the depth before them is
+        with self.lock:
+            ready = self._ready_decisions()
+        for r in ready:
+            self.send_decision(r)
+
+    def _finish_commits(self, commits):
+        if not commits:
+            return
+        # Everything applied together shares one group commit
+        started = time.perf_counter()
+        if not self.state_log.wait(commits[-1][0]):
+            # The blocks are still held by the quorum that decided them; our own copy is written
+            # again when a recovery or restart rewrites the whole state
+            print(f"Could not write the state log: {self.state_log.error}")
+        self.metrics.observe("commit_wait", time.perf_counter() - started)
+        for _, rejected, lost, replies in commits:
+            for tx in rejected:
+                print(f"Rejected transfer {tx}: insufficient balance in account {tx[0]}")
+            self._requeue(lost)
+            self._reply_outcomes(replies)
+            print("Done.")
+
+    def _reply_outcomes(self, replies):
+        # Tells every peer whose transfers we committed or rejected how they ended, ourselves included
+        for origin_id, (seqs, rejected) in replies.items():
+            if origin_id == self.id:
+                self._report(seqs, "committed")
+                self._report(rejected, "rejected")
+            else:
+                self.send(origin_id, {"type": "Forward Reply", "from": self.id, "seqs": seqs, "rejected": rejected})
+
+    def implement_decision(self, new_block, refs=()):
+        # Caller holds self.apply_lock. Returns the log sequence number to wait for and the
+        # follow-up work that may only happen once the block is durable.
+        started = time.perf_counter()
+        with self.lock:
+            transactions = transactions_of(new_block.transaction)
+            effect, rejected = apply_transactions(self.account_table, transactions)
+            self.blockchain.append(new_block)
+            depth = self.blockchain.len
+            balances = {account: self.account_table[account] for account in effect}
+            if self.history is not None:
+                self.history.record(depth, balances)
+            self.accepted.pop(depth, None)
+            # A decision for this depth may have arrived while it came in through a recovery
+            self.decided.pop(depth, None)
+            self.gap_since = None
+            lost, replies = self._complete_round(depth, new_block, rejected, refs)
+            if self.preparing and self.prepare_depth <= depth:
+                # Someone else decided the depth we were preparing for
+                self.preparing = False
+                self.pending_cv.notify()
+            values = {"account_table": self.account_table, "promised_ballot": self.promised_ballot, "balances": balances}
+
+        seq = self.state_log.append(values, new_block, depth)
+        self.metrics.observe("apply", time.perf_counter() - started)
+        self.metrics.count("blocks_applied")
+        return seq, rejected, lost, replies
+
+    def _complete_round(self, depth, block, rejected, refs=()):
+        # Caller holds self.lock. Returns the batches to requeue and, per origin, the sequence
+        # numbers of its transfers that were committed and of those that were rejected. `refs`
+        # names the transfers of a block someone else proposed; ours are named by our round.
+        lost = []
+        replies = {}
+        r = self.rounds.pop(depth, None)
+        matched = r is not None and r.block.hash_value == block.hash_value and r.block.nonce == block.nonce
+        outcomes = self._record_outcomes(transactions_of(block.transaction), rejected, r.refs if matched else refs)
+        if outcomes:
+            self.block_refs[depth] = list(outcomes)
+            while len(self.block_refs) > REF_BLOCKS:
+                self.block_refs.popitem(last=False)
+        for ref, outcome in outcomes.items():
+            # Every origin hears from whoever proposed the block; our own transfers may also have been
+            # decided in a block of another proposer, such as the leader we forwarded them to
+            if matched or ref[0] == self.id:
+                committed, refused = replies.setdefault(ref[0], ([], []))
+                (committed if outcome == "committed" else refused).append(ref[1])
+        if self.id in replies and self.forwarded:
+            self._forwards_settled(replies[self.id][0] + replies[self.id][1], self.clock())
+        if r is not None:
+            self.attempts = 0
+            self.stalls = 0
+            if not matched:
+                if self.debug:
+                    print(f"[DEBUG C-{self.id}] Block lost depth {depth}, requeueing {len(r.batch)} transfers")
+                lost.extend(r.batch)
+                # Later in-flight blocks were built on the lost one
+                for d in sorted(self.rounds):
+                    if d > depth:
+                        lost.extend(self.rounds.pop(d).batch)
+                lost = [entry for entry in lost if entry[2] not in outcomes]
+            if not self.stable_leader and not self.rounds:
+                self.is_leader = False
+            self.pending_cv.notify()
+        return lost, replies
+
+    def _record_outcomes(self, transactions, rejected, refs):
+        # Caller holds self.lock. Remembers how each transfer of a decided block ended, so that
+        # none of them is proposed again by us or by a peer that forwards it to us once more
+        outcomes = dict.fromkeys(refs, "committed")
+        if rejected:
+            skipped = Counter(rejected)
+            for tx, ref in zip(transactions, refs):
+                if skipped[tx]:
+                    skipped[tx] -= 1
+                    outcomes[ref] = "rejected"
+        self.outcomes.update(outcomes)
+        while len(self.outcomes) > OUTCOME_MEMORY:
+            self.outcomes.popitem(last=False)
+        return outcomes
 
     def moneyTransfer(self, from_id, to_id, amount):
+        handle = self.transfer(from_id, to_id, amount)
+        return handle.seq if handle is not None else None
+
+    def transfer(self, from_id, to_id, amount, timeout=None):
+        # Queues a transfer and returns a handle to wait on, or None if it is refused. Waits up to
+        # `timeout` seconds (forever for None) while the peer already has max_pending transfers in flight.
         from_id = int(from_id)
         to_id = int(to_id)
         amount = int(amount)
@@ -377,104 +928,544 @@ class Peer:
         if amount <= 0:
             print("Amount must be positive")
             return
-        
-        with self.lock:
-            current_balance = self.account_table.get(from_id, 0)
-            if current_balance < amount:
-                print(f"Insufficient balance in account {from_id}. Current balance: {current_balance}, amount needed: {amount}")
-                return
+
+        tx = (from_id, to_id, amount)
+        try:
+            handle = self.admission.admit(tx, lambda: self.account_table.get(from_id, 0), timeout)
+        except ValueError as e:
+            print(e)
+            return
+        if handle is None:
+            print(f"{self.admission.capacity} transfers already in flight, try again later")
+            return
             
         if self.debug:
             print(f"[DEBUG C-{self.id}] Transfer from C-{from_id}, to C-{to_id}, amount={amount}")
 
-        self.proposed_block = self.blockchain.new_block((from_id, to_id, amount))
-        self.send_prepare()
+        with self.pending_cv:
+            self.forward_seq += 1
+            seq = self.forward_seq
+            self.admission.register(seq, handle)
+            self.pending.append((tx, self.clock(), (self.id, seq)))
+            self.pending_cv.notify()
+        return handle
+
+    def print_pending(self):
+        handles, reserved = self.admission.pending()
+        for handle in handles:
+            print(f"Transfer {handle.seq}: {handle.tx[0]} -> {handle.tx[1]}, amount {handle.tx[2]}")
+        print(f"{len(handles)} transfers in flight, reserved {reserved}")
+
+    def _batch_wait(self):
+        # Caller holds self.lock. Returns 0 when a batch should be taken now, else how long to wait.
+        if not self.pending:
+            return 1.0
+        forwarding = self.stable_leader and not self.is_leader and self.leader_id not in (None, self.id) and self.pending[0][2][0] == self.id
+        if not forwarding and (self.preparing or len(self.rounds) >= self.window or (self.rounds and not self.is_leader)):
+            return 1.0
+        if not forwarding and self.retry_at is not None:
+            return max(self.retry_at - self.clock(), 0.001)
+        linger = self.pending[0][1] + self.batch_linger - self.clock()
+        if len(self.pending) >= self.batch_size or linger <= 0:
+            return 0
+        return linger
+
+    def _take_batch(self):
+        # Caller holds self.lock
+        forward_to = None
+        if self.stable_leader and not self.is_leader and self.leader_id not in (None, self.id):
+            # Transfers forwarded to us are proposed here rather than passed along again
+            if self.pending[0][2][0] == self.id:
+                forward_to = self.leader_id
+
+        entries = []
+        while self.pending and len(entries) < self.batch_size:
+            if forward_to is not None and self.pending[0][2][0] != self.id:
+                break
+            entry = self.pending.popleft()
+            if self.outcomes.get(entry[2]) is None:
+                entries.append(entry)
+        if forward_to is not None:
+            return forward_to, entries, {}
+
+        # Drop transfers that can no longer be covered once everything ahead of them is applied
+        _, rejected = net_effect(self._projection(), [entry[0] for entry in entries])
+        batch = []
+        refused = {}
+        for entry in entries:
+            if entry[0] in rejected:
+                rejected.remove(entry[0])
+                print(f"Insufficient balance for transfer {entry[0]}, dropping it")
+                self.outcomes[entry[2]] = "rejected"
+                refused.setdefault(entry[2][0], ([], []))[1].append(entry[2][1])
+            else:
+                batch.append(entry)
+        return None, batch, refused
+
+    def _projection(self):
+        # Caller holds self.lock. Returns balance(account) once every block in flight is applied, None
+        # for an unknown account; the blocks' effects are summed once rather than on every lookup
+        in_flight = Counter()
+        for r in self.rounds.values():
+            in_flight.update(r.effect)
+        table = self.account_table
+        return lambda account: table[account] + in_flight[account] if account in table else None
+
+    def _requeue(self, batch):
+        if not batch:
+            return
+        with self.pending_cv:
+            self.pending.extendleft(reversed(batch))
+            self.pending_cv.notify()
 
-    def handle_recovery(self, req):
-        from_id = req["from"]
-        blockchain_list = []
-        for block in self.blockchain:
-            blockchain_list.append(dict_from_block(block))
-        msg = {
-            "type": "Recovery Reply",
-            "from": self.id,
-            "blockchain": blockchain_list,
-            "account_table": self.account_table,
-            "promised_ballot": self.promised_ballot
-        }
-        self.send(from_id, msg)
+    def _proposer_thread(self):
+        while True:
+            self._check_timeouts()
+            with self.lock:
+                wait = self._batch_wait()
+                if wait > 0:
+                    self.pending_cv.wait(min(wait, self._next_deadline(self.clock())))
+                    continue
+                forward_to, batch, refused = self._take_batch()
+            self._reply_outcomes(refused)
+            if not batch:
+                continue
+            if forward_to is not None:
+                self.forward(forward_to, batch)
+            else:
+                self.propose(batch)
 
-    def recover(self, req):
-        from_id = req["from"]
-        self.recovery_event.clear()
+    def propose(self, batch):
+        # The proof of work depends only on the transactions, so it runs without holding the lock
+        transaction = normalize_transaction([tx for tx, _, _ in batch])
+        encoding = canonical_encoding(transaction)
+        nonce, hash_value = generate_hash(transaction, self.pow_workers, encoding, self.rng.randrange(NONCE_START_LIMIT))
 
-        blockchain_list = req["blockchain"]
         with self.lock:
-            if (len(blockchain_list) < self.blockchain.len) or (len(blockchain_list) == self.blockchain.len and from_id < self.id):
-                self.recovery_event.set()
-                return
+            depth = max([self.blockchain.len, *self.rounds]) + 1
+            prev = self.rounds[depth - 1].block if depth - 1 in self.rounds else self.blockchain.get_tail()
+            block = Block.reconstruct(transaction, nonce, hash_value, prev, pointer_digest(prev), encoding)
+            effect, _ = net_effect(self._projection(), [tx for tx, _, _ in batch])
+            r = Round(depth, block, batch, self.clock(), effect)
+            self.rounds[depth] = r
+            skip_prepare = self.is_leader
+        if self.debug:
+            print(f"[DEBUG C-{self.id}] Proposing block with {len(batch)} transfers at depth {depth}")
+        if skip_prepare:
+            self.send_accept(r)
+        else:
+            self.send_prepare()
 
-        new_blockchain = build_blockchain_from_list(blockchain_list)
-        if new_blockchain.verify() == False:
+    def _check_timeouts(self):
+        now = self.clock()
+        with self.lock:
+            dropped = 0
+            unknown = []
+            if any(now - r.started > self.round_timeout for r in self.rounds.values()) or (self.preparing and now - self.prepare_started > self.round_timeout):
+                # Every later block depends on the stalled one, so the whole window is given up
+                dropped = sum(len(r.batch) for r in self.rounds.values())
+                unknown = [ref[1] for r in self.rounds.values() for _, _, ref in r.batch if ref[0] == self.id]
+                self.rounds = {}
+                self.is_leader = False
+                self.preparing = False
+                self.retry_at = None
+                self.attempts = 0
+                self.stalls = 0
+            backoff = self._stalled(now)
+            ballot = self.ballot
+            retry = self.retry_at is not None and now >= self.retry_at
+            if retry:
+                self.retry_at = None
+                retry = bool(self.rounds) and not self.preparing and not self.is_leader
+            expired = []
+            resend = {}
+            reclaimed = []
+            forwarded = list(self.forwarded.items()) if now >= self.forward_check_at else []
+            if forwarded:
+                self.forward_check_at = now + self.forward_timer.timeout() / 4
+            for seq, (sent, leader_id, entry, last_sent, attempts) in forwarded:
+                if now - sent > self.round_timeout:
+                    expired.append(seq)
+                    del self.forwarded[seq]
+                    if self.leader_id == leader_id:
+                        self.leader_id = None
+                elif now - last_sent > self.forward_timer.timeout(attempts):
+                    if leader_id == self.leader_id and attempts < FORWARD_RETRIES:
+                        # The leader drops forwards it has seen before, so only the same leader is asked again
+                        self.forwarded[seq] = (sent, leader_id, entry, now, attempts + 1)
+                        resend.setdefault(leader_id, []).append(entry)
+                    else:
+                        # The leader looks dead or has changed, so we propose the transfer ourselves. Should
+                        # it be decided after all, its (origin, seq) shows up in the decision and we drop it.
+                        del self.forwarded[seq]
+                        reclaimed.append(entry)
+                        if self.leader_id == leader_id:
+                            self.leader_id = None
+            recover_from = None
+            if self.gap_since is not None and now - self.gap_since > self.round_timeout / 4:
+                # Asked again every interval while the gap lasts; without a known leader any member will do
+                self.gap_since = now
+                others = self.config.others(self.id)
+                recover_from = self.leader_id if self.leader_id not in (None, self.id) else (self.rng.choice(others) if others else None)
+            escalate = self._escalations(now) if self.thrifty else []
+        for msg, targets in escalate:
+            if targets:
+                self.count("thrifty_escalations")
+                self.broadcast(msg, targets)
+        if backoff is not None:
+            self.count("round_retries")
             if self.debug:
-                print(f"[DEBUG C-{self.id}] Received invalid blockchain from C-{from_id}")
-
+                print(f"[DEBUG C-{self.id}] No quorum for ballot {ballot}, preparing again in {backoff * 1000:.0f} ms (attempt {self.attempts})")
+        if retry:
+            self.send_prepare()
+        for leader_id, entries in resend.items():
+            self.count("forward_retries", len(entries))
+            self.send(leader_id, self._forward_msg(entries))
+        if dropped:
+            print(f"Transfer round timed out, dropping {dropped} transfers")
+        if reclaimed:
+            self.count("forward_fallbacks", len(reclaimed))
+            print(f"Leader did not answer, proposing {len(reclaimed)} transfers here")
+            self._requeue(reclaimed)
+        if expired:
+            print(f"Leader did not answer, dropping {len(expired)} transfers")
+        self._report(unknown + expired, "unknown")
+        if recover_from is not None and recover_from != self.id:
+            self.request_recovery(recover_from)
+
+    def forward(self, leader_id, batch):
+        now = self.clock()
         with self.lock:
-            self.account_table = {int(k): v for k, v in req["account_table"].items()}
-            self.blockchain = new_blockchain
-            self.promised_ballot = max(getattr(self, "promised_ballot", (0,0)), tuple(req.get("promised_ballot", (0,0))))
-            self.highest_accepted_num = None
-            self.highest_accepted_val = None
-            self.proposed_block = None
-
-        overwrite_file(f"./data/c_{self.id}.json", self.account_table, self.promised_ballot, new_blockchain)
-        self.recovery_event.set()
-        print("Done.")
-
+            for entry in batch:
+                self.forwarded[entry[2][1]] = (now, leader_id, entry, now, 0)
+        if self.debug:
+            print(f"[DEBUG C-{self.id}] Forwarding {len(batch)} transfers to leader C-{leader_id}")
+        self.send(leader_id, self._forward_msg(batch))
 
-    def _listener_thread(self):
-        c_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        c_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        c_socket.bind((self.ip, self.id * 1234))
-        c_socket.listen(5)
-        c_socket.settimeout(1.0)
+    def _forward_msg(self, batch):
+        return {
+            "type": "Forward",
+            "from": self.id,
+            "transfers": [[list(tx), list(ref)] for tx, _, ref in batch]
+        }
 
-        if self.debug:
-            print(f"[DEBUG C-{self.id}] Listening on port {self.id*1234}")
+    def handle_forward(self, req):
+        now = self.clock()
+        settled = {}
+        with self.pending_cv:
+            for tx, ref in req["transfers"]:
+                ref = tuple(ref)
+                if ref in self.outcomes:
+                    # Sent again because the reply did not arrive; answer it if it is settled already
+                    outcome = self.outcomes[ref]
+                    if outcome is not None:
+                        committed, rejected = settled.setdefault(ref[0], ([], []))
+                        (committed if outcome == "committed" else rejected).append(ref[1])
+                    continue
+                self.outcomes[ref] = None
+                self.pending.append((tuple(tx), now, ref))
+            while len(self.outcomes) > OUTCOME_MEMORY:
+                self.outcomes.popitem(last=False)
+            self.pending_cv.notify()
+        self._reply_outcomes(settled)
+
+    def handle_forward_reply(self, req):
+        rejected = req.get("rejected", [])
+        now = self.clock()
+        with self.lock:
+            self._forwards_settled(req["seqs"] + rejected, now)
+        self._report(req["seqs"], "committed")
+        self._report(rejected, "rejected")
+
+    def _forwards_settled(self, seqs, now):
+        # Caller holds self.lock. Only transfers sent once say how long a reply takes
+        samples = [now - forwarded[3] for forwarded in (self.forwarded.pop(seq, None) for seq in seqs) if forwarded is not None and forwarded[4] == 0]
+        if samples:
+            self.forward_timer.observe(max(samples))
+
+    def _report(self, seqs, outcome):
+        # A transfer may be reported by more than one proposer; only the first report counts
+        for seq in seqs:
+            if not self.admission.settle(seq, outcome):
+                continue
+            if outcome == "committed" and self.on_commit is not None:
+                self.on_commit(seq)
+            if self.on_outcome is not None:
+                self.on_outcome(seq, outcome)
 
-        while True:
-            try:
-                conn, addr = c_socket.accept()
+    def recovery_request(self):
+        with self.lock:
+            tail = self.blockchain.get_tail()
+            return {
+                "type": "Recovery",
+                "from": self.id,
+                "depth": self.blockchain.len,
+                "tail_hash": tail.hash_value if tail else None
+            }
+
+    def request_recovery(self, target_id):
+        with self.lock:
+            now = self.clock()
+            if self.recovering_since is not None and now - self.recovering_since < 2:
+                return
+            self.recovering_since = now
+        print("Recovering")
+        self.send(target_id, self.recovery_request())
 
-                length_bytes = conn.recv(4)
-                length = int.from_bytes(length_bytes, "big")
-                data = b""
-                while len(data) < length:
-                    data += conn.recv(length - len(data))
+    def handle_recovery(self, req):
+        from_id = req["from"]
+        depth = req.get("depth", 0)
+        tail_hash = req.get("tail_hash")
 
-                req = json.loads(data.decode())
-                client_id = req.get('from', None)
+        with self.lock:
+            length = self.blockchain.len
+            start = 0
+            if depth > length:
+                # The requester is ahead of us; an empty reply tells it so without streaming our chain
+                start = length
+            elif 0 < depth:
+                if next(self.blockchain.blocks(depth - 1)).hash_value == tail_hash:
+                    # Same prefix: only the blocks the requester is missing are sent
+                    start = depth
+            # Blocks below `length` never change, so they can be streamed after the lock is released
+            blocks = self.blockchain.blocks(start, length)
+            account_table = dict(self.account_table)
+            promised_ballot = self.promised_ballot
+            self.recovery_session += 1
+            session = self.recovery_session
+        if self.debug:
+            print(f"[DEBUG C-{self.id}] Sending {length - start} blocks from depth {start + 1} to C-{from_id}")
+
+        # At most RECOVERY_CHUNK blocks are encoded at a time, and sending blocks until the requester keeps up
+        seq = 0
+        chunk = []
+        for depth, block in enumerate(blocks, start=start + 1):
+            info = dict_from_block(block)
+            refs = self.block_refs.get(depth)
+            if refs is not None:
+                info["refs"] = refs
+            chunk.append(info)
+            if len(chunk) == RECOVERY_CHUNK:
+                self.send_recovery_chunk(from_id, session, seq, start, length, chunk)
+                seq += 1
+                chunk = []
+        if chunk:
+            self.send_recovery_chunk(from_id, session, seq, start, length, chunk)
+            seq += 1
+        msg = {
+            "type": "Recovery Reply",
+            "from": self.id,
+            "session": session,
+            "seq": seq,
+            "start": start,
+            "depth": length,
+            "account_table": account_table,
+            "promised_ballot": promised_ballot
+        }
+        self.send(from_id, msg)
 
-                if self.debug == 1:
-                    print(f"[DEBUG C-{self.id}] Received request from C-{client_id}: {req}")
-                elif self.debug == 2:
-                    print(f"[DEBUG C-{self.id}] Received request from C-{client_id}, Type: {req["type"]}")
+    def send_recovery_chunk(self, target_id, session, seq, start, depth, chunk):
+        msg = {
+            "type": "Recovery Chunk",
+            "from": self.id,
+            "session": session,
+            "seq": seq,
+            "start": start,
+            "depth": depth,
+            "blockchain": chunk
+        }
+        self.send(target_id, msg, compress=True)
+
+    def handle_recovery_stream(self, req, streams):
+        # Called from the connection thread, so a stream's messages are handled in order and a
+        # slow requester holds back the sender instead of queueing the whole chain in memory
+        key = (req["from"], req["session"])
+        stream = streams.get(key)
+        if stream is None:
+            if req["seq"] != 0:
+                return
+            stream = self.open_recovery_stream(req)
+            streams[key] = stream
+        if req["type"] == "Recovery Reply":
+            streams.pop(key)
+            self.close_recovery_stream(stream, req)
+        elif not stream["ignored"]:
+            self.recover_chunk(stream, req["blockchain"])
+
+    def open_recovery_stream(self, req):
+        from_id = req["from"]
+        start = req["start"]
+        depth = req["depth"]
+        stream = {"from": from_id, "start": start, "depth": depth, "received": 0, "chain": None, "ignored": True}
+        with self.lock:
+            stream["started"] = self.recovering_since if self.recovering_since is not None else self.clock()
+            self.recovering_since = None
+            if (depth < self.blockchain.len) or (depth == self.blockchain.len and from_id < self.id):
+                return stream
+            if start > 0 and start > self.blockchain.len:
+                restart = True
+            else:
+                restart = False
+                if start == 0:
+                    # Only one full chain is rebuilt at a time; other replies are dropped unless the
+                    # one being rebuilt has stalled, e.g. because its last message was lost
+                    current = self.full_recovery
+                    if current is not None and self.clock() - current["progress"] < self.round_timeout / 4:
+                        return stream
+                    if current is not None:
+                        current["ignored"] = True
+                    self.full_recovery = stream
+                    stream["progress"] = self.clock()
+                    stream["chain"] = BlockChain()
+                    stream["refs"] = {}
+                stream["ignored"] = False
+        if restart:
+            # Our chain changed underneath the request; ask again from where we are now
+            self.request_recovery(from_id)
+        return stream
+
+    def recover_chunk(self, stream, blockchain_list):
+        first = stream["start"] + stream["received"] + 1
+        if stream["chain"] is None:
+            valid = self.recover_suffix(stream["from"], first, blockchain_list)
+        else:
+            valid = self.recover_blocks(stream["chain"], blockchain_list, stream["refs"])
+            stream["progress"] = self.clock()
+        stream["received"] += len(blockchain_list)
+        if not valid:
+            if self.debug:
+                print(f"[DEBUG C-{self.id}] Received invalid block at depth {first} or later from C-{stream["from"]}")
+            self.drop_recovery_stream(stream)
+            return
+        total = stream["depth"] - stream["start"]
+        if total > RECOVERY_CHUNK:
+            print(f"Recovering from C-{stream["from"]}: {stream["received"]}/{total} blocks")
+
+    def drop_recovery_stream(self, stream):
+        stream["ignored"] = True
+        if stream["chain"] is not None:
+            stream["chain"] = None
+            with self.lock:
+                if self.full_recovery is stream:
+                    self.full_recovery = None
+
+    def close_recovery_stream(self, stream, req):
+        if stream["ignored"]:
+            return
+        if stream["received"] != stream["depth"] - stream["start"]:
+            self.drop_recovery_stream(stream)
+            return
+        promised_ballot = tuple(req.get("promised_ballot", (0,0)))
+        if stream["chain"] is None:
+            with self.lock:
+                self.promised_ballot = max(self.promised_ballot, promised_ballot)
+        else:
+            self.recover_full(stream["chain"], req["account_table"], promised_ballot, stream["refs"])
+            with self.lock:
+                if self.full_recovery is stream:
+                    self.full_recovery = None
+        self.metrics.observe("recovery", self.clock() - stream["started"])
+        self.metrics.count("recoveries")
+        self.metrics.count("recovery_blocks", stream["received"])
+        self._apply_decided()
+
+    def recover_suffix(self, from_id, start, blockchain_list):
+        commits = []
+        valid = True
+        with self.apply_lock:
+            for i, info in enumerate(blockchain_list, start=start):
+                with self.lock:
+                    if i <= self.blockchain.len:
+                        continue
+                    tail = self.blockchain.get_tail()
+                    block = Block.reconstruct(tx=info["transaction"], nonce=info["nonce"], hash_value=info["hash_value"], prev=tail, hash_pointer=info["hash_pointer"])
+                    valid = i == self.blockchain.len + 1 and block.verify(tail)
+                if not valid:
+                    break
+                commits.append(self.implement_decision(block, list(map(tuple, info.get("refs", ())))))
+        self._finish_commits(commits)
+        # Applying clears the gap timer, so it is set again here in case the rest of the stream is lost
+        self._apply_decided()
+        return valid
+
+    def recover_blocks(self, new_blockchain, blockchain_list, refs):
+        for info in blockchain_list:
+            tail = new_blockchain.get_tail()
+            block = Block.reconstruct(tx=info["transaction"], nonce=info["nonce"], hash_value=info["hash_value"], prev=tail, hash_pointer=info["hash_pointer"])
+            if not block.verify(tail):
+                return False
+            new_blockchain.append(block)
+            if "refs" in info:
+                refs[new_blockchain.len] = list(map(tuple, info["refs"]))
+        return True
+
+    def recover_full(self, new_blockchain, account_table, promised_ballot, refs):
+        with self.apply_lock:
+            with self.lock:
+                if new_blockchain.len < self.blockchain.len:
+                    return
+                self.account_table = {int(k): v for k, v in account_table.items()}
+                self.blockchain = new_blockchain
+                self.history = None
+                self.promised_ballot = max(self.promised_ballot, promised_ballot)
+                lost = []
+                replies = {}
+                for depth in sorted(d for d in self.rounds if d <= new_blockchain.len):
+                    # The balances before the block are not at hand, so none of its transfers count as rejected
+                    more_lost, more_replies = self._complete_round(depth, new_blockchain[depth - 1], [], refs.get(depth, ()))
+                    lost.extend(more_lost)
+                    for origin_id, (seqs, rejected) in more_replies.items():
+                        committed, refused = replies.setdefault(origin_id, ([], []))
+                        committed.extend(seqs)
+                        refused.extend(rejected)
+                self.accepted = {d: v for d, v in self.accepted.items() if d > new_blockchain.len}
+                self.decided = {d: b for d, b in self.decided.items() if d > new_blockchain.len}
+                self.block_refs = OrderedDict(sorted(refs.items())[-REF_BLOCKS:])
+                if self.preparing and self.prepare_depth <= new_blockchain.len:
+                    self.preparing = False
+
+            if not self.state_log.reset(self.account_table, self.promised_ballot, new_blockchain):
+                print(f"Could not write the recovered state: {self.state_log.error}")
+
+        self._requeue(lost)
+        self._reply_outcomes(replies)
+        print("Done.")
 
-                if not self.dead:
-                    self.request_queue.put(req)
-                elif self.debug:
-                    print(f"[DEBUG C-{self.id}] Process dead, ignoring")
+    def receive(self, req):
+        # Called by the transport for every frame; returns False when the frame needs no handler
+        self.count("frames_received")
+        client_id = req.get('from', None)
 
-                conn.close()
-            except socket.timeout:
-                continue
+        if self.debug == 1:
+            print(f"[DEBUG C-{self.id}] Received request from C-{client_id}: {req}")
+        elif self.debug == 2:
+            print(f"[DEBUG C-{self.id}] Received request from C-{client_id}, Type: {req["type"]}")
 
-    def _worker_thread(self):
-        while True:
-            req = self.request_queue.get()
-            time.sleep(3) # Simulated network delay
-            self.handle_request(req)
-            self.request_queue.task_done()
+        if self.dead:
+            if self.debug:
+                print(f"[DEBUG C-{self.id}] Process dead, ignoring")
+            return False
+        if req["type"] == "Hello":
+            self.peer_wire[client_id] = set(req.get("wire", []))
+            return False
+        return True
+
+    def superseded(self, req):
+        # True when the handler would ignore req anyway, so a transport can drop it without running it.
+        # Accepts and Prepares are always handled: their Nack tells the sender of a newer ballot or depth.
+        with self.lock:
+            match req["type"]:
+                case "Decision":
+                    stale = req["depth"] <= self.blockchain.len
+                case "Promise":
+                    stale = not self.preparing or tuple(req["ballot"]) != self.ballot or req["depth"] != self.prepare_depth
+                case "Accepted":
+                    stale = tuple(req["ballot"]) != self.ballot or req["depth"] not in self.rounds
+                case _:
+                    stale = False
+        if stale:
+            self.metrics.count("superseded_dropped")
+        return stale
 
     def handle_request(self, req):
         msg_type = req.get("type", None)
@@ -496,10 +1487,14 @@ class Peer:
                 self.handle_accepted(req)
             case "Decision":
                 self.handle_decision(req) 
+            case "Nack":
+                self.handle_nack(req)
+            case "Forward":
+                self.handle_forward(req)
+            case "Forward Reply":
+                self.handle_forward_reply(req)
             case "Recovery":
                 self.handle_recovery(req)
-            case "Recovery Reply":
-                self.recover(req) 
             case "DEBUG":
                 print(f"[DEBUG C-{self.id}] Debug Message from C-{req['from']}: {req['text']}")   
                 debug_reply = {
@@ -512,11 +1507,21 @@ class Peer:
                 print(f"[DEBUG C-{self.id}] Debug Reply Message from C-{req['from']}: {req['text']}")   
                  
 # Paxos Message format:
-# type: "Promise", ballot: ballot_Num, from: proposer_id, depth: depth, accepted_ballot: _, accepted_tx: _, accepted_nonce: _, accepted_hash: _, accepted_hash_pointer: _
+# type: "Promise", ballot: ballot_Num, from: proposer_id, depth: depth, accepted: [[depth, accepted_ballot, block with refs], ...] for every depth >= depth
 # type: "Prepare", ballot: ballot_Num, from: proposer_id, depth: depth
-# type: "Accept", ballot: ballot_Num, from: proposer_id, tx: _, nonce: _, hash_value: _, hash_pointer: _
-# type: "Accepted", ballot: ballot_Num, from: accepter_id
-# type: "Decision", tx: _, nonce: _, hash_value: _, hash_pointer: _
+# type: "Accept", ballot: ballot_Num, from: proposer_id, depth: depth, tx: _, nonce: _, hash_value: _, hash_pointer: _, refs: [[origin_id, seq], ...] one per transfer
+# type: "Accepted", ballot: ballot_Num, from: accepter_id, depth: depth
+# type: "Nack", ballot: rejected ballot, from: accepter_id, promised: promised_ballot, depth: accepter's chain length
+# type: "Decision", from: id, depth: depth, tx: _, nonce: _, hash_value: _, hash_pointer: _, refs: _
+
+# type: "Hello", from: id, wire: [binary wire versions the sender can read] (first frame on every connection)
+
+# Prepare, Promise, Accept, Accepted, Nack, Decision and Recovery are sent in the binary layouts of wire.py
+# to peers whose Hello lists WIRE_VERSION, and as JSON otherwise.
+
+# type: "Forward", from: id, transfers: [[tx, [origin_id, seq]], ...]
+# type: "Forward Reply", from: id of the peer that applied the block, seqs: [seq, ...] committed, rejected: [seq, ...] rejected for lack of funds
 
-# type: "Recovery", from: id
-# type: "Recovery Reply", from: id, bc: serialized_blockchain, at: account_table, pb: promised_ballot, han: highest_accepted_num, hav: highest_accepted_val
+# type: "Recovery", from: id, depth: chain length, tail_hash: hash of the last block
+# type: "Recovery Chunk", from: id, session: _, seq: chunk number, start: depth the blocks follow (0 = full chain), depth: chain length, blockchain: [block with refs if still known, ...] (at most RECOVERY_CHUNK, zlib compressed frame)
+# type: "Recovery Reply", from: id, session: _, seq: number of chunks sent, start: _, depth: _, account_table: _, promised_ballot: _
@@ -0,0 +1,364 @@
+from utils import FrameReader, parse_frame_header, decode_frame
+from collections import deque
+import heapq
+import queue
+import random
+import select
+import socket
+import threading
+import time
+
+# Seconds every message is held before it is handled, to make the protocol visible by hand
+NETWORK_DELAY = 3
+# Frames of a recovery stream are handled in order where they arrive instead of being queued
+RECOVERY_STREAM = ("Recovery Chunk", "Recovery Reply")
+# Queued messages run in this order, so the ones that let a depth finish never wait behind new work
+PRIORITY = {
+    "Decision": 0,
+    "Forward Reply": 0,
+    "Accepted": 1,
+    "Promise": 1,
+    "Nack": 1,
+    "Accept": 2,
+    "Prepare": 3,
+    "Forward": 4,
+}
+LOWEST_PRIORITY = 5
+# Frames waiting for one target; a broadcast frame for a target this far behind is dropped
+SEND_QUEUE = 256
+CONNECT_TIMEOUT = 1.0
+SEND_TIMEOUT = 5.0
+
+class RequestScheduler:
+    # Strict priority between message classes; within a class the senders take turns, and each
+    # sender's messages stay in the order they arrived
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.classes = [{} for _ in range(LOWEST_PRIORITY + 1)]
+        self.size = 0
+
+    def put(self, req, queued):
+        senders = self.classes[PRIORITY.get(req.get("type"), LOWEST_PRIORITY)]
+        with self.cv:
+            pending = senders.get(req.get("from"))
+            if pending is None:
+                pending = senders[req.get("from")] = deque()
+            pending.append((req, queued))
+            self.size += 1
+            self.cv.notify()
+
+    def get(self):
+        with self.cv:
+            while not self.size:
+                self.cv.wait()
+            for senders in self.classes:
+                if senders:
+                    # Taking the first sender and putting it back last is the round robin
+                    sender = next(iter(senders))
+                    pending = senders.pop(sender)
+                    item = pending.popleft()
+                    if pending:
+                        senders[sender] = pending
+                    self.size -= 1
+                    return item
+
+# A transport moves encoded frames between peers. It is started with start(peer), delivers frames
+# through peer.receive() and peer.handle_request(), and provides the clock the peer times itself with.
+# Handlers pass work that may block on the peer's locks or its disk to run_blocking(fn, *args).
+
+class TcpTransport:
+    # Real sockets: a listener thread, a reader thread per incoming connection, worker threads that
+    # handle messages after the simulated network delay, and a sender thread per target, so that a
+    # slow or unreachable peer only holds up the frames addressed to it
+    def __init__(self, delay=NETWORK_DELAY, workers=4):
+        self.delay = delay
+        self.workers = workers
+        self.request_queue = RequestScheduler()
+        self.connections = {}
+        self.outboxes = {}
+        self.outbox_lock = threading.Lock()
+
+    def clock(self):
+        return time.monotonic()
+
+    def start(self, peer):
+        self.peer = peer
+        threading.Thread(target=self._listener_thread, daemon=True).start()
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker_thread, daemon=True).start()
+
+    def run_blocking(self, fn, *args):
+        # Handlers already run on worker threads
+        fn(*args)
+
+    def send(self, target_id, frame):
+        # Returns once the frame is written, which is what holds back a recovery stream
+        written = threading.Event()
+        self._outbox(target_id).put((frame, time.perf_counter(), lambda target_id, sent: written.set()))
+        written.wait()
+
+    def broadcast(self, frames, timeout=None):
+        # frames maps each target to its frame. Without a timeout this returns at once; with one it
+        # waits up to `timeout` seconds and returns the targets the frame was written to.
+        cv = threading.Condition()
+        waiting = set(frames)
+        reached = set()
+
+        def done(target_id, sent):
+            with cv:
+                waiting.discard(target_id)
+                if sent:
+                    reached.add(target_id)
+                cv.notify_all()
+
+        queued = time.perf_counter()
+        for target_id, frame in frames.items():
+            try:
+                self._outbox(target_id).put_nowait((frame, queued, done if timeout is not None else None))
+            except queue.Full:
+                self.peer.count("frames_dropped")
+                done(target_id, False)
+        if timeout is None:
+            return None
+        with cv:
+            cv.wait_for(lambda: not waiting, timeout)
+            return set(reached)
+
+    def _outbox(self, target_id):
+        outbox = self.outboxes.get(target_id)
+        if outbox is None:
+            with self.outbox_lock:
+                outbox = self.outboxes.get(target_id)
+                if outbox is None:
+                    outbox = self.outboxes[target_id] = queue.Queue(SEND_QUEUE)
+                    threading.Thread(target=self._sender_thread, args=(target_id, outbox), daemon=True).start()
+        return outbox
+
+    def _sender_thread(self, target_id, outbox):
+        while True:
+            frame, queued, done = outbox.get()
+            sent = self._write(target_id, frame)
+            self.peer.metrics.observe(f"send_to_{target_id}", time.perf_counter() - queued)
+            if done is not None:
+                done(target_id, sent)
+
+    def _write(self, target_id, frame):
+        for attempt in range(2):
+            try:
+                conn = self._get_connection(target_id)
+                conn.sendall(frame)
+                self.peer.count("frames_sent")
+                return True
+            except Exception as e:
+                self._close_connection(target_id)
+                if attempt == 1 and self.peer.debug:
+                    print(f"[DEBUG C-{self.peer.id}] Could not send message to C-{target_id}, Error: {e}")
+        return False
+
+    def _get_connection(self, target_id):
+        # Only the target's sender thread uses its connection
+        conn = self.connections.get(target_id)
+        if conn is not None and self._is_stale(conn):
+            self._close_connection(target_id)
+            conn = None
+        if conn is None:
+            if target_id in self.connections:
+                self.peer.count("reconnects")
+            conn = socket.create_connection(self.peer.config.address(target_id), timeout=CONNECT_TIMEOUT)
+            conn.settimeout(SEND_TIMEOUT)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[target_id] = conn
+            conn.sendall(self.peer.hello_frame())
+            if self.peer.debug:
+                print(f"[DEBUG C-{self.peer.id}] Opened connection to C-{target_id}")
+        return conn
+
+    def _is_stale(self, conn):
+        # Outgoing connections are write-only, so readability means the peer closed it
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _close_connection(self, target_id):
+        conn = self.connections.get(target_id)
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+            self.connections[target_id] = None
+
+    def _listener_thread(self):
+        c_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        c_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        host, port = self.peer.config.address(self.peer.id)
+        c_socket.bind((host, port))
+        c_socket.listen(self.peer.config.size)
+        c_socket.settimeout(1.0)
+
+        if self.peer.debug:
+            print(f"[DEBUG C-{self.peer.id}] Listening on {host}:{port}")
+
+        while True:
+            try:
+                conn, addr = c_socket.accept()
+                conn.settimeout(None)
+                threading.Thread(target=self._connection_thread, args=(conn,), daemon=True).start()
+            except socket.timeout:
+                continue
+
+    def _connection_thread(self, conn):
+        reader = FrameReader(conn)
+        streams = {}
+        with conn:
+            while True:
+                try:
+                    req = reader.read()
+                    if req is None:
+                        break
+                except (OSError, ValueError) as e:
+                    if self.peer.debug:
+                        print(f"[DEBUG C-{self.peer.id}] Closing connection, Error: {e}")
+                    break
+                if not self.peer.receive(req):
+                    continue
+                if req["type"] in RECOVERY_STREAM:
+                    self.peer.handle_recovery_stream(req, streams)
+                elif req["type"] == "Recovery":
+                    # Serving a recovery waits for the requester to keep up, so it gets its own thread
+                    threading.Thread(target=self._serve_recovery, args=(req,), daemon=True).start()
+                else:
+                    self.request_queue.put(req, time.perf_counter())
+        # A stream cut off by a dropped connection is abandoned; the gap timer asks again
+        for stream in streams.values():
+            self.peer.drop_recovery_stream(stream)
+
+    def _worker_thread(self):
+        while True:
+            req, queued = self.request_queue.get()
+            self.peer.metrics.observe("queue_wait", time.perf_counter() - queued)
+            if self.peer.superseded(req):
+                # Dropped before it holds a worker for the network delay
+                continue
+            time.sleep(self.delay) # Simulated network delay
+            self.peer.handle_request(req)
+
+    def _serve_recovery(self, req):
+        time.sleep(self.delay) # Simulated network delay
+        self.peer.handle_request(req)
+
+class SimNetwork:
+    # An in-memory network for running a whole cluster in one process. Frames are delivered in
+    # virtual time by one driver thread, in order of arrival time, so a handler never waits for a
+    # socket or a sleep. The clock jumps straight to the next delivery; while nothing is in flight
+    # it moves with real time, so that the peers' timeouts still fire.
+    #
+    # latency is seconds, or a function of a random.Random returning seconds, e.g.
+    # lambda rng: rng.expovariate(1000). drop is the chance that a frame is lost.
+    def __init__(self, latency=0.001, drop=0.0, seed=0, tick=0.001):
+        self.latency = latency
+        self.drop = drop
+        self.tick = tick
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.seq = 0
+        self.events = []
+        self.links = {}
+        self.groups = None
+        self.transports = {}
+        self.cv = threading.Condition()
+        self.stats = {"delivered": 0, "dropped": 0, "partitioned": 0}
+        threading.Thread(target=self._driver_thread, daemon=True).start()
+
+    def clock(self):
+        return self.now
+
+    def transport(self):
+        return SimTransport(self)
+
+    def set_link(self, src, dst, latency=None, drop=None):
+        # Overrides latency and drop for frames from src to dst
+        with self.cv:
+            self.links[(src, dst)] = (self.latency if latency is None else latency, self.drop if drop is None else drop)
+
+    def partition(self, *groups):
+        # Only peers in the same group can reach each other until heal()
+        with self.cv:
+            self.groups = [set(group) for group in groups]
+
+    def heal(self):
+        with self.cv:
+            self.groups = None
+
+    def _reachable(self, src, dst):
+        return self.groups is None or any(src in group and dst in group for group in self.groups)
+
+    def schedule(self, src, dst, frame):
+        with self.cv:
+            if not self._reachable(src, dst):
+                self.stats["partitioned"] += 1
+                return
+            latency, drop = self.links.get((src, dst), (self.latency, self.drop))
+            if drop and self.rng.random() < drop:
+                self.stats["dropped"] += 1
+                return
+            delay = latency(self.rng) if callable(latency) else latency
+            self.seq += 1
+            heapq.heappush(self.events, (self.now + max(delay, 0), self.seq, src, dst, frame))
+            self.cv.notify()
+
+    def _driver_thread(self):
+        while True:
+            with self.cv:
+                while not self.events:
+                    idle_since = time.monotonic()
+                    self.cv.wait(self.tick)
+                    self.now += time.monotonic() - idle_since
+                when, _, src, dst, frame = heapq.heappop(self.events)
+                self.now = max(self.now, when)
+                target = self.transports.get(dst)
+                self.stats["delivered"] += 1
+            if target is not None:
+                target.deliver(src, frame)
+
+class SimTransport:
+    def __init__(self, network):
+        self.network = network
+        self.clock = network.clock
+        self.opened = set()
+        self.streams = {}
+
+    def start(self, peer):
+        self.peer = peer
+        with self.network.cv:
+            self.network.transports[peer.id] = self
+
+    def run_blocking(self, fn, *args):
+        # Run in place, so a simulated cluster stays in step with its virtual clock
+        fn(*args)
+
+    def send(self, target_id, frame):
+        if target_id not in self.opened:
+            # Stands in for opening a connection, which starts with a Hello
+            self.opened.add(target_id)
+            self.network.schedule(self.peer.id, target_id, self.peer.hello_frame())
+        self.network.schedule(self.peer.id, target_id, frame)
+        self.peer.count("frames_sent")
+
+    def broadcast(self, frames, timeout=None):
+        # Scheduling never blocks, so every frame counts as sent
+        for target_id, frame in frames.items():
+            self.send(target_id, frame)
+        return set(frames) if timeout is not None else None
+
+    def deliver(self, src, frame):
+        length, compressed = parse_frame_header(frame[:4])
+        req = decode_frame(memoryview(frame)[4:4 + length], compressed)
+        if not self.peer.receive(req):
+            return
+        if req["type"] in RECOVERY_STREAM:
+            self.peer.handle_recovery_stream(req, self.streams.setdefault(src, {}))
+        else:
+            self.peer.handle_request(req)
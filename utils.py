@@ -1,51 +1,250 @@
-from blockchain import Block, BlockChain
+from blockchain import Block, BlockChain, transactions_of
+import threading
+import time
 import os
 import json
+import zlib
+import struct
+import chainfile
+import wire
 
 def ensure_dir(path):
     directory = os.path.dirname(path)
     if directory:
         os.makedirs(directory, exist_ok=True)
 
+FRAME_COMPRESSED = 1 << 31
+MAX_FRAME = 64 * 1024 * 1024
+
+def encode_payload(msg, binary=False):
+    if binary and msg["type"] in wire.TYPE_CODES:
+        try:
+            return wire.encode(msg)
+        except (ValueError, TypeError, KeyError, struct.error):
+            pass  # fields the binary layout cannot carry unchanged go as JSON
+    return json.dumps(msg).encode()
+
+def decode_payload(payload):
+    if payload[:1] == b"{":
+        return json.loads(payload)
+    return wire.decode(payload)
+
+def encode_frame(msg, compress=False, binary=False):
+    data = encode_payload(msg, binary)
+    length = len(data)
+    if compress:
+        data = zlib.compress(data)
+        length = len(data) | FRAME_COMPRESSED
+    return length.to_bytes(4, "big") + data
+
+def parse_frame_header(header):
+    length = int.from_bytes(header, "big")
+    compressed = bool(length & FRAME_COMPRESSED)
+    length &= ~FRAME_COMPRESSED
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME} byte limit")
+    return length, compressed
+
+def decode_frame(data, compressed):
+    return decode_payload(zlib.decompress(data) if compressed else bytes(data))
+
+class FrameReader:
+    # Reads length-prefixed frames into one buffer that is reused for the life of the connection
+    def __init__(self, conn, size=64 * 1024):
+        self.conn = conn
+        self.buf = bytearray(size)
+
+    def _fill(self, n):
+        if n > len(self.buf):
+            self.buf = bytearray(max(n, 2 * len(self.buf)))
+        view = memoryview(self.buf)
+        received = 0
+        while received < n:
+            k = self.conn.recv_into(view[received:n])
+            if k == 0:
+                return None
+            received += k
+        return view[:n]
+
+    def read(self):
+        header = self._fill(4)
+        if header is None:
+            return None
+        length, compressed = parse_frame_header(header)
+        data = self._fill(length)
+        if data is None:
+            return None
+        return decode_frame(data, compressed)
+
+def apply_transactions(account_table, transactions):
+    # Applies the transfers to account_table in place and returns the change to each account touched
+    # and the transfers rejected. Only those accounts are written, so the cost does not grow with the table.
+    effect, rejected = net_effect(account_table.get, transactions)
+    for account, change in effect.items():
+        account_table[account] += change
+    return effect, rejected
+
+def net_effect(balance, transactions):
+    # Like apply_transactions, but returns the change to each account touched instead of making it.
+    # balance(account) is the balance before, or None for an unknown account.
+    effect = {}
+    rejected = []
+    for tx in transactions:
+        from_id, to_id, amount = int(tx[0]), int(tx[1]), int(tx[2])
+        from_balance = balance(from_id)
+        if from_balance is None or balance(to_id) is None or amount <= 0 or from_balance + effect.get(from_id, 0) < amount:
+            rejected.append(tuple(tx))
+            continue
+        effect[from_id] = effect.get(from_id, 0) - amount
+        effect[to_id] = effect.get(to_id, 0) + amount
+    return effect, rejected
+
 def read_json(path):
     if not os.path.isfile(path):
         return {}
     with open(path, "r") as f:
         return json.load(f)
 
-def write_json(path, data):
-    ensure_dir(path)
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
-    
-def handle_file(path, values, new_block):
-    data = read_json(path) or {}
+def log_paths(path):
+    # c_<id>.json is the checkpoint, c_<id>.chain the block log (indexed by c_<id>.idx) and
+    # c_<id>.wal the variable log
+    base = os.path.splitext(path)[0]
+    return base + ".chain", base + ".wal"
+
+def history_paths(path):
+    # c_<id>.hist holds, for every block, the balance after it of each account it moved money for,
+    # and c_<id>.snap the account table of every checkpoint. Both only spare the balance history a
+    # replay of the chain, so they are not fsynced; whatever they miss is replayed.
+    base = os.path.splitext(path)[0]
+    return base + ".hist", base + ".snap"
+
+# A block in c_<id>.hist is one record per account it touched, followed by (depth, 0, number of accounts)
+HISTORY_RECORD = struct.Struct(">IIq")
 
-    data.setdefault("variables", {})
-    data.setdefault("blockchain", [])
+def encode_history(depth, balances):
+    records = [HISTORY_RECORD.pack(depth, account, balance) for account, balance in balances.items()]
+    records.append(HISTORY_RECORD.pack(depth, 0, len(balances)))
+    return b"".join(records)
 
+def read_history(path, depth):
+    # Yields (depth, {account: balance}) for the blocks of a .hist file in order, up to `depth`
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    balances = {}
+    expected = 1
+    for d, account, value in HISTORY_RECORD.iter_unpack(memoryview(data)[:len(data) - len(data) % HISTORY_RECORD.size]):
+        if account:
+            balances[account] = value
+            continue
+        if d != expected or d > depth or value != len(balances):
+            return
+        yield d, balances
+        balances = {}
+        expected += 1
+
+def open_history(path, chain_len):
+    # Cuts a .hist file back to its last complete block no deeper than chain_len, e.g. after a torn
+    # write or a chain tail that was cut off, and returns that block's depth
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = f.seek(0, os.SEEK_END) // HISTORY_RECORD.size * HISTORY_RECORD.size
+        while end > 0:
+            f.seek(end - HISTORY_RECORD.size)
+            depth, account, _ = HISTORY_RECORD.unpack(f.read(HISTORY_RECORD.size))
+            if account == 0 and depth <= chain_len:
+                break
+            end -= HISTORY_RECORD.size
+        else:
+            depth = 0
+        f.truncate(end)
+    return depth
+
+def read_snapshots(path):
+    # Yields (depth, account table) for every snapshot in a .snap file
+    for record in read_lines(path):
+        yield record["depth"], {int(k): v for k, v in record["account_table"].items()}
+
+def encode_variables(values):
+    variables = {}
     for k, v in values.items():
-        data["variables"][k] = v
+        if k == "account_table":
+            variables[k] = {str(i): amount for i, amount in v.items()}
+        elif isinstance(v, tuple):
+            variables[k] = list(v)
+        else:
+            variables[k] = v
+    return variables
 
-    if new_block is not None:
-        block_dict = dict_from_block(new_block)
-        data["blockchain"].append(block_dict)
+def append_lines(path, lines):
+    ensure_dir(path)
+    with open(path, "ab") as f:
+        f.write(b"".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
 
-    write_json(path, data)
+def read_lines(path):
+    if not os.path.isfile(path):
+        return []
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # torn write at the end of the log
+    return records
 
-def load_file(path):
+def load_file(path, workers=1):
     data = read_json(path) or {}
-    if not data:
+    chain_path, wal_path = log_paths(path)
+    verified = data.get("verified", {})
+    if chainfile.is_chain_file(chain_path):
+        # Index entries up to the checkpoint were fsynced before it was written
+        legacy = None
+        blockchain = BlockChain(chainfile.ChainFile(chain_path, trusted=data.get("chain_len", 0)))
+    else:
+        # State from before the binary chain file: the whole chain is in JSON and gets converted
+        legacy = data.get("blockchain", []) + read_lines(chain_path)
+        blockchain = build_blockchain_from_list(legacy)
+    wal = read_lines(wal_path)
+    if not data and not blockchain.len and not wal:
         print("File Not Found or empty")
         return None, None, None
 
     variables = data.get("variables", {})
+    chain_len = data.get("chain_len", len(data.get("blockchain", [])))
+    for record in wal:
+        variables.update(record["variables"])
+        if "account_table" in record["variables"]:
+            # Logs written before the table was left out of them
+            chain_len = record.get("chain_len", chain_len)
 
     account_table = {int(k): int(v) for k, v in variables.get("account_table", {}).items()} or {}
     promised_ballot = tuple(variables.get("promised_ballot", (0, 0)))
 
-    blocks = data.get("blockchain", [])
-    blockchain = build_blockchain_from_list(blocks) if blocks else BlockChain()
+    # Blocks up to the last checkpoint were verified before they were stored; only the rest is checked
+    start = verified.get("depth", 0)
+    if not (0 < start <= blockchain.len and blockchain[start - 1].hash_value == verified.get("tail_hash")):
+        start = 0
+    if not blockchain.verify(workers, start):
+        print("Stored blockchain failed verification")
+        return None, None, None
+
+    # The table is as of the checkpoint; the blocks logged after it are replayed
+    for block in blockchain.blocks(chain_len):
+        apply_transactions(account_table, transactions_of(block.transaction))
+
+    if legacy is not None:
+        # Move state files from before the append-only logs and the binary chain over to the new layout
+        overwrite_file(path, account_table, promised_ballot, blockchain)
+    elif start < blockchain.len:
+        write_checkpoint(path, {"account_table": account_table, "promised_ballot": promised_ballot}, blockchain.len, blockchain.tail.hash_value)
 
     return account_table, promised_ballot, blockchain
 
@@ -54,7 +253,7 @@ def build_blockchain_from_list(blocks):
     prev_block = None
     for block in blocks:
         new_block = Block.reconstruct(
-                        tx=tuple(block["transaction"]),
+                        tx=block["transaction"],
                         nonce=block["nonce"],
                         hash_value=block["hash_value"],
                         prev=prev_block,
@@ -66,19 +265,180 @@ def build_blockchain_from_list(blocks):
 
 def dict_from_block(block):
     block_dict = {
-                "transaction": list(block.transaction) if isinstance(block.transaction, (tuple, list)) else block.transaction,
+                "transaction": [list(tx) if isinstance(tx, tuple) else tx for tx in block.transaction] if isinstance(block.transaction, list) else list(block.transaction),
                 "nonce": block.nonce,
                 "hash_value": block.hash_value,
                 "hash_pointer": block.hash_pointer,
             }
     return block_dict
 
+def write_atomic(path, payload):
+    ensure_dir(path)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def write_checkpoint(path, values, chain_len, tail_hash=None):
+    # Every stored block was verified before it was appended, so the checkpoint also
+    # records how far the chain on disk is known to be valid
+    chain_path, wal_path = log_paths(path)
+    chainfile.sync_index(chain_path)
+    data = {"variables": encode_variables(values), "chain_len": chain_len}
+    if tail_hash is not None:
+        data["verified"] = {"depth": chain_len, "tail_hash": tail_hash}
+    write_atomic(path, json.dumps(data, indent=2).encode())
+    with open(wal_path, "wb") as f:
+        os.fsync(f.fileno())
+
 def overwrite_file(path, account_table, promised_ballot, blockchain):
-    data = {
-        "variables": {
-            "account_table": {str(k): v for k, v in account_table.items()},
-            "promised_ballot": list(promised_ballot)
-        },
-        "blockchain": [dict_from_block(b) for b in blockchain]
-    }
-    write_json(path, data)
+    chain_path, _ = log_paths(path)
+    ensure_dir(chain_path)
+    chainfile.write_chain(chain_path, blockchain)
+    tail = blockchain.get_tail()
+    write_checkpoint(path, {"account_table": account_table, "promised_ballot": promised_ballot}, blockchain.len, tail.hash_value if tail else None)
+
+class StateLog:
+    # Appends blocks and the promised ballot to the logs from one writer thread. Everything
+    # queued while the previous fsync ran is written and fsynced together (group commit), and
+    # every `checkpoint_every` commits the account table is written into the checkpoint; loading
+    # replays the blocks after it, so the table is never part of the log itself. The same thread
+    # appends the balance history's files (see history_paths), in depth order: a block that does not
+    # follow the last one written is left out until append_history() fills the gap.
+    # With no path nothing is written and every append is durable at once. After a failed write
+    # nothing more is written until reset() rewrites the whole state.
+    def __init__(self, path, checkpoint_every=256, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self.chain_path, self.wal_path = log_paths(path) if path else (None, None)
+        self.hist_path, self.snap_path = history_paths(path) if path else (None, None)
+        self.history_depth = 0
+        self.checkpoint_every = checkpoint_every
+        self.cv = threading.Condition()
+        self.queue = []
+        self.queued = 0
+        self.durable = 0
+        self.since_checkpoint = 0
+        self.tail_hash = None
+        self.error = None
+        self.stats = {"commits": 0, "fsyncs": 0, "write_errors": 0}
+        if path:
+            threading.Thread(target=self._writer_thread, daemon=True).start()
+
+    def append(self, values, new_block, chain_len):
+        with self.cv:
+            self.queued += 1
+            if not self.path:
+                self.durable = self.queued
+                self.stats["commits"] += 1
+                return self.queued
+            if self.error is None:
+                # Only a checkpoint needs the table, so only then is it copied
+                self.since_checkpoint += 1
+                checkpoint = None
+                if self.since_checkpoint >= self.checkpoint_every:
+                    checkpoint = {"account_table": dict(values["account_table"]), "tail_hash": new_block.hash_value}
+                    self.since_checkpoint = 0
+                self.queue.append((values["promised_ballot"], new_block, chain_len, checkpoint, [(chain_len, values["balances"])] if "balances" in values else []))
+                self.cv.notify_all()
+            return self.queued
+
+    def open_history(self, chain_len):
+        # For a loaded state: history blocks are appended after the last complete one on disk
+        if self.path:
+            self.history_depth = open_history(self.hist_path, chain_len)
+
+    def append_history(self, groups):
+        # Writes (depth, balances) of blocks the history file missed; no one waits for them
+        with self.cv:
+            if self.path and self.error is None and groups:
+                self.queue.append((None, None, None, None, groups))
+                self.cv.notify_all()
+
+    def wait(self, seq):
+        # True once everything up to `seq` is durable, False if the log failed before that
+        with self.cv:
+            while self.durable < seq and self.error is None:
+                self.cv.wait()
+            return self.durable >= seq
+
+    def reset(self, account_table, promised_ballot, blockchain):
+        # Returns False if the state could not be written
+        with self.cv:
+            while self.durable < self.queued and self.error is None:
+                self.cv.wait()
+            if self.path:
+                try:
+                    overwrite_file(self.path, account_table, promised_ballot, blockchain)
+                    # The history of the old chain no longer holds; the new one is replayed when first needed
+                    with open(self.hist_path, "wb"):
+                        pass
+                    write_atomic(self.snap_path, json.dumps({"depth": blockchain.len, "account_table": {str(i): amount for i, amount in account_table.items()}}).encode() + b"\n")
+                except OSError as e:
+                    self._fail(e)
+                    return False
+                self.history_depth = 0
+            # The rewritten state holds everything queued before it
+            self.queue = []
+            self.durable = self.queued
+            self.error = None
+            self.since_checkpoint = 0
+            tail = blockchain.get_tail()
+            self.tail_hash = tail.hash_value if tail else None
+            return True
+
+    def _fail(self, error):
+        # Caller holds self.cv. Later groups are not written after a lost one, as the chain file would have a gap.
+        self.error = error
+        self.queue = []
+        self.stats["write_errors"] += 1
+        self.cv.notify_all()
+
+    def _writer_thread(self):
+        while True:
+            with self.cv:
+                while not self.queue:
+                    self.cv.wait()
+                group = self.queue
+                self.queue = []
+                seq = self.queued
+
+            started = time.perf_counter()
+            blocks = [b for _, b, _, _, _ in group if b is not None]
+            ballots = [promised_ballot for promised_ballot, _, _, _, _ in group if promised_ballot is not None]
+            checkpoints = [(chain_len, checkpoint) for _, _, chain_len, checkpoint, _ in group if checkpoint is not None]
+            history = []
+            for _, _, _, _, groups in group:
+                for depth, balances in groups:
+                    if depth == self.history_depth + 1:
+                        history.append(encode_history(depth, balances))
+                        self.history_depth = depth
+            try:
+                if blocks:
+                    chainfile.append_blocks(self.chain_path, blocks)
+                    self.tail_hash = blocks[-1].hash_value
+                if ballots:
+                    append_lines(self.wal_path, [json.dumps({"variables": encode_variables({"promised_ballot": ballots[-1]})}).encode() + b"\n"])
+                if history:
+                    with open(self.hist_path, "ab") as f:
+                        f.write(b"".join(history))
+
+                if checkpoints:
+                    chain_len, checkpoint = checkpoints[-1]
+                    write_checkpoint(self.path, {"account_table": checkpoint["account_table"], "promised_ballot": ballots[-1]}, chain_len, checkpoint["tail_hash"])
+                    with open(self.snap_path, "ab") as f:
+                        f.write(json.dumps({"depth": chain_len, "account_table": {str(i): amount for i, amount in checkpoint["account_table"].items()}}).encode() + b"\n")
+            except OSError as e:
+                with self.cv:
+                    self._fail(e)
+                continue
+            if self.metrics is not None:
+                self.metrics.observe("persist", time.perf_counter() - started)
+
+            with self.cv:
+                self.durable = seq
+                self.stats["commits"] += sum(1 for _, block, _, _, _ in group if block is not None)
+                self.stats["fsyncs"] += bool(blocks) + bool(ballots)
+                self.cv.notify_all()
@@ -0,0 +1,163 @@
+import itertools
+import struct
+
+# Binary layouts for the Paxos messages that are sent most often. A binary payload starts with
+# WIRE_VERSION and a type code; JSON payloads start with "{", so a receiver can tell them apart.
+WIRE_VERSION = 2
+
+TYPE_CODES = {
+    "Prepare": 1,
+    "Promise": 2,
+    "Accept": 3,
+    "Accepted": 4,
+    "Nack": 5,
+    "Decision": 6,
+    "Recovery": 7,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+HEADER = struct.Struct(">BBH")     # version, type code, from
+BALLOT = struct.Struct(">IH")      # ballot number, proposer id
+DEPTH = struct.Struct(">I")
+TRANSFER = struct.Struct(">HHI")   # from, to, amount; transfers outside this range go as JSON
+COUNT = struct.Struct(">BI")       # 1 = list of transfers, 0 = single transfer from before batching; count
+REF = struct.Struct(">HI")         # origin peer and sequence number of a transfer, kept out of the block hash
+
+def _hash_bytes(h):
+    raw = bytes.fromhex(h)
+    if len(raw) != 32 or raw.hex() != h:
+        raise ValueError(f"Not a lowercase sha256 hex digest: {h!r}")
+    return raw
+
+def _optional_hash(h):
+    return b"\x00" if h is None else b"\x01" + _hash_bytes(h)
+
+def _block(parts, tx, nonce, hash_value, hash_pointer):
+    batched = bool(tx) and isinstance(tx[0], (list, tuple))
+    transfers = tx if batched else [tx]
+    parts.append(COUNT.pack(batched, len(transfers)))
+    flat = [v for transfer in transfers for v in transfer]
+    if len(flat) != 3 * len(transfers) or not all(type(v) is int for v in flat):
+        # The block hash covers the JSON form of the transfer, which must come back unchanged
+        raise TypeError(f"Transfers must be three ints: {tx}")
+    parts.append(struct.pack(">" + "HHI" * len(transfers), *flat))
+    raw_nonce = nonce.encode("ascii")
+    parts.append(bytes([len(raw_nonce)]) + raw_nonce)
+    parts.append(_hash_bytes(hash_value))
+    parts.append(_optional_hash(hash_pointer))
+
+def _refs(parts, refs):
+    parts.append(DEPTH.pack(len(refs)) + b"".join(itertools.starmap(REF.pack, refs)))
+
+def encode(msg):
+    # Raises ValueError, TypeError, KeyError or struct.error when msg has no binary layout
+    msg_type = msg["type"]
+    parts = [HEADER.pack(WIRE_VERSION, TYPE_CODES[msg_type], msg["from"])]
+    match msg_type:
+        case "Prepare" | "Accepted":
+            parts.append(BALLOT.pack(*msg["ballot"]) + DEPTH.pack(msg["depth"]))
+        case "Promise":
+            parts.append(BALLOT.pack(*msg["ballot"]) + DEPTH.pack(msg["depth"]) + DEPTH.pack(len(msg["accepted"])))
+            for depth, ballot, block in msg["accepted"]:
+                parts.append(DEPTH.pack(depth) + BALLOT.pack(*ballot))
+                _block(parts, block["transaction"], block["nonce"], block["hash_value"], block["hash_pointer"])
+                _refs(parts, block.get("refs", []))
+        case "Accept":
+            parts.append(BALLOT.pack(*msg["ballot"]) + DEPTH.pack(msg["depth"]))
+            _block(parts, msg["tx"], msg["nonce"], msg["hash_value"], msg["hash_pointer"])
+            _refs(parts, msg.get("refs", []))
+        case "Nack":
+            parts.append(BALLOT.pack(*msg["ballot"]) + BALLOT.pack(*msg["promised"]) + DEPTH.pack(msg["depth"]))
+        case "Decision":
+            parts.append(DEPTH.pack(msg["depth"]))
+            _block(parts, msg["tx"], msg["nonce"], msg["hash_value"], msg["hash_pointer"])
+            _refs(parts, msg.get("refs", []))
+        case "Recovery":
+            parts.append(DEPTH.pack(msg["depth"]) + _optional_hash(msg["tail_hash"]))
+    return b"".join(parts)
+
+def encode_block(tx, nonce, hash_value, hash_pointer):
+    # The block layout on its own, as the chain file stores it
+    parts = []
+    _block(parts, tx, nonce, hash_value, hash_pointer)
+    return b"".join(parts)
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, layout):
+        try:
+            values = layout.unpack_from(self.data, self.offset)
+        except struct.error as e:
+            raise ValueError(f"Truncated binary message: {e}")
+        self.offset += layout.size
+        return values
+
+    def take(self, n):
+        if self.offset + n > len(self.data):
+            raise ValueError("Truncated binary message")
+        raw = bytes(self.data[self.offset:self.offset + n])
+        self.offset += n
+        return raw
+
+    def ballot(self):
+        return self.unpack(BALLOT)
+
+    def depth(self):
+        return self.unpack(DEPTH)[0]
+
+    def optional_hash(self):
+        return self.take(32).hex() if self.take(1) == b"\x01" else None
+
+    def block(self):
+        batched, count = self.unpack(COUNT)
+        transfers = list(map(list, TRANSFER.iter_unpack(self.take(count * TRANSFER.size))))
+        if not transfers:
+            raise ValueError("Block without transfers")
+        tx = transfers if batched else transfers[0]
+        nonce = self.take(self.take(1)[0]).decode("ascii")
+        hash_value = self.take(32).hex()
+        return {"transaction": tx, "nonce": nonce, "hash_value": hash_value, "hash_pointer": self.optional_hash()}
+
+    def refs(self):
+        return list(REF.iter_unpack(self.take(self.depth() * REF.size)))
+
+def decode_block(data):
+    return _Reader(data).block()
+
+def decode(data):
+    # Builds the same dict the JSON form of the message would give
+    r = _Reader(data)
+    version, code, from_id = r.unpack(HEADER)
+    if version != WIRE_VERSION or code not in TYPE_NAMES:
+        raise ValueError(f"Unknown binary message version {version}, type {code}")
+    msg_type = TYPE_NAMES[code]
+    msg = {"type": msg_type, "from": from_id}
+    match msg_type:
+        case "Prepare" | "Accepted":
+            msg["ballot"] = r.ballot()
+            msg["depth"] = r.depth()
+        case "Promise":
+            msg["ballot"] = r.ballot()
+            msg["depth"] = r.depth()
+            msg["accepted"] = [[r.depth(), r.ballot(), {**r.block(), "refs": r.refs()}] for _ in range(r.depth())]
+        case "Accept" | "Decision":
+            if msg_type == "Accept":
+                msg["ballot"] = r.ballot()
+            msg["depth"] = r.depth()
+            block = r.block()
+            msg["tx"] = block["transaction"]
+            msg["nonce"] = block["nonce"]
+            msg["hash_value"] = block["hash_value"]
+            msg["hash_pointer"] = block["hash_pointer"]
+            msg["refs"] = r.refs()
+        case "Nack":
+            msg["ballot"] = r.ballot()
+            msg["promised"] = r.ballot()
+            msg["depth"] = r.depth()
+        case "Recovery":
+            msg["depth"] = r.depth()
+            msg["tail_hash"] = r.optional_hash()
+    return msg